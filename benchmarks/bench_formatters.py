@@ -0,0 +1,80 @@
+import os
+import sys
+from textwrap import dedent
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_formatters import escape, get_cart_summary, get_product_summary  # noqa: E402
+
+
+def legacy_escape(s):
+    return s.replace('-', '\\-').replace('.', '\\.').replace('(', '\\(').replace(')', '\\)')
+
+
+def legacy_get_cart_summary(products, cost):
+    if not products:
+        return 'Здесь пока пусто.'
+    summary = ''
+    for product in products:
+        summary += f'''\
+            *{product["name"]}* (_{product["description"]}_)
+            {product["quantity"]} шт. на сумму {product["total_cost"]}
+            \n'''
+    summary = dedent(summary) + f'*К оплате: {cost}*'
+    return summary
+
+
+def legacy_get_product_summary(product):
+    summary = f'''\
+            *{product["name"]} / {product["price"]}*
+
+            _{product["description"]}_
+            '''
+    if product['quantity_in_cart']:
+        summary += f'''\
+
+            В корзине: *{product["quantity_in_cart"]} шт.*
+            '''
+    return dedent(summary)
+
+
+def main():
+    products = [{
+        'name': f'Пицца №{number}',
+        'description': 'Тесто, соус, сыр-моцарелла (100 г), пепперони.',
+        'quantity': number % 3 + 1,
+        'total_cost': f'{number * 100} ₽'
+    } for number in range(1, 6)]
+    product = {
+        'name': 'Пепперони',
+        'price': '599 ₽',
+        'description': 'Тесто, соус, сыр-моцарелла (100 г), пепперони.',
+        'quantity_in_cart': 2
+    }
+    number = 20000
+    cases = [
+        (
+            'escape',
+            lambda: legacy_escape(product['description']),
+            lambda: escape(product['description'])
+        ),
+        (
+            'cart summary',
+            lambda: legacy_escape(legacy_get_cart_summary(products, '1500 ₽')),
+            lambda: get_cart_summary(products, '1500 ₽')
+        ),
+        (
+            'product caption',
+            lambda: legacy_escape(legacy_get_product_summary(product)),
+            lambda: get_product_summary(product)
+        ),
+    ]
+    for name, legacy, current in cases:
+        legacy_time = timeit(legacy, number=number) / number * 1e6
+        current_time = timeit(current, number=number) / number * 1e6
+        print(f'{name}: legacy {legacy_time:.2f} µs, current {current_time:.2f} µs, x{legacy_time / current_time:.1f}')
+
+
+if __name__ == '__main__':
+    main()
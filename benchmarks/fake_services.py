@@ -0,0 +1,297 @@
+import json
+import random
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import parse_qs, urlsplit
+from uuid import uuid4
+
+
+class FakeService:
+    routes = []
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self._lock = Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        service = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def handle_request(self, method):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                status, response = service.dispatch(method, self.path, self.headers, body)
+                response_body = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response_body)))
+                self.end_headers()
+                self.wfile.write(response_body)
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_PUT(self):
+                self.handle_request('PUT')
+
+            def do_DELETE(self):
+                self.handle_request('DELETE')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def dispatch(self, method, path, headers, body):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            sleep(self.latency)
+        url = urlsplit(path)
+        if 'json' in headers.get('Content-Type', ''):
+            payload = json.loads(body or b'{}')
+        else:
+            payload = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        for route_method, pattern, handler_name in self.routes:
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                return getattr(self, handler_name)(*match.groups(), query=query, payload=payload)
+        return 404, {'errors': [{'detail': f'{method} {url.path} is not emulated'}]}
+
+
+class FakeMoltin(FakeService):
+    routes = [
+        ('POST', r'/oauth/access_token', 'create_token'),
+        ('GET', r'/v2/products', 'get_products'),
+        ('GET', r'/v2/products/([^/]+)', 'get_product'),
+        ('GET', r'/v2/carts/([^/]+)/items/?', 'get_cart'),
+        ('POST', r'/v2/carts/([^/]+)/items/?', 'add_to_cart'),
+        ('DELETE', r'/v2/carts/([^/]+)/items/?', 'empty_cart'),
+        ('PUT', r'/v2/carts/([^/]+)/items/([^/]+)', 'update_cart_item'),
+        ('DELETE', r'/v2/carts/([^/]+)/items/([^/]+)', 'remove_from_cart'),
+        ('GET', r'/v2/flows/([^/]+)/entries', 'get_entries'),
+        ('GET', r'/v2/flows/([^/]+)/entries/([^/]+)', 'get_entry'),
+        ('POST', r'/v2/flows/([^/]+)/entries', 'add_entry'),
+    ]
+
+    def __init__(self, products=30, pizzerias=200, latency=0.0):
+        super().__init__(latency)
+        self.products = {}
+        for number in range(products):
+            product_id = str(uuid4())
+            self.products[product_id] = {
+                'id': product_id,
+                'type': 'product',
+                'name': f'Пицца №{number}',
+                'description': 'Тесто, соус, сыр-моцарелла (100 г), пепперони.',
+                'price_amount': 300 + number * 10,
+                'image_id': str(uuid4())
+            }
+        self.flows = {'pizzeria': {}, 'customer_address': {}}
+        for number in range(pizzerias):
+            pizzeria_id = str(uuid4())
+            self.flows['pizzeria'][pizzeria_id] = {
+                'id': pizzeria_id,
+                'address': f'Москва, улица Пиццерий, {number}',
+                'alias': f'pizzeria-{number}',
+                'latitude': 55.55 + random.random() * 0.4,
+                'longitude': 37.35 + random.random() * 0.5,
+                'deliveryman_telegram_id': 1000 + number
+            }
+        self.carts = {}
+
+    def serialize_product(self, product):
+        return {
+            'id': product['id'],
+            'type': 'product',
+            'name': product['name'],
+            'description': product['description'],
+            'relationships': {'main_image': {'data': {'type': 'main_image', 'id': product['image_id']}}},
+            'meta': {
+                'display_price': {'with_tax': {'amount': product['price_amount'],
+                                               'formatted': f'{product["price_amount"]} ₽'}},
+                'stock': {'level': 100}
+            }
+        }
+
+    def serialize_cart(self, reference):
+        items = []
+        for product_id, item in self.carts.get(reference, {}).items():
+            product = self.products[product_id]
+            amount = product['price_amount'] * item['quantity']
+            items.append({
+                'id': item['id'],
+                'type': 'cart_item',
+                'product_id': product_id,
+                'name': product['name'],
+                'description': product['description'],
+                'quantity': item['quantity'],
+                'value': {'amount': amount},
+                'meta': {'display_price': {'with_tax': {'unit': {'formatted': f'{product["price_amount"]} ₽'}}}}
+            })
+        total = sum(item['value']['amount'] for item in items)
+        return {'data': items, 'meta': {'display_price': {'with_tax': {'amount': total, 'formatted': f'{total} ₽'}}}}
+
+    def paginate(self, path, items, query):
+        limit = int(query.get('page[limit]', 100))
+        offset = int(query.get('page[offset]', 0))
+        include = f'&include={query["include"]}' if 'include' in query else ''
+        next_url = None
+        if offset + limit < len(items):
+            next_url = f'{self.url}{path}?page[limit]={limit}&page[offset]={offset + limit}{include}'
+        return {
+            'data': items[offset:offset + limit],
+            'links': {
+                'current': f'{self.url}{path}?page[limit]={limit}&page[offset]={offset}{include}',
+                'next': next_url
+            },
+            'meta': {
+                'page': {'limit': limit, 'offset': offset},
+                'results': {'total': len(items)}
+            }
+        }
+
+    def create_token(self, query, payload):
+        return 200, {'access_token': uuid4().hex, 'expires': int(time()) + 3600, 'expires_in': 3600}
+
+    def serialize_main_image(self, product):
+        return {
+            'id': product['image_id'],
+            'type': 'file',
+            'link': {'href': f'https://example.com/{product["image_id"]}.jpg'}
+        }
+
+    def get_products(self, query, payload):
+        products = [self.serialize_product(product) for product in self.products.values()]
+        response = self.paginate('/v2/products', products, query)
+        if query.get('include') == 'main_image':
+            response['included'] = {'main_images': [
+                self.serialize_main_image(self.products[product['id']]) for product in response['data']
+            ]}
+        return 200, response
+
+    def get_product(self, product_id, query, payload):
+        product = self.products[product_id]
+        response = {'data': self.serialize_product(product)}
+        if query.get('include') == 'main_image':
+            response['included'] = {'main_images': [self.serialize_main_image(product)]}
+        return 200, response
+
+    def get_cart(self, reference, query, payload):
+        with self._lock:
+            return 200, self.serialize_cart(reference)
+
+    def add_to_cart(self, reference, query, payload):
+        product_id = payload['data']['id']
+        if product_id not in self.products:
+            return 404, {'errors': [{'status': 404, 'detail': 'The requested product could not be found'}]}
+        with self._lock:
+            item = self.carts.setdefault(reference, {}).setdefault(product_id, {'id': str(uuid4()), 'quantity': 0})
+            item['quantity'] += payload['data']['quantity']
+            return 201, self.serialize_cart(reference)
+
+    def empty_cart(self, reference, query, payload):
+        with self._lock:
+            self.carts.pop(reference, None)
+            return 200, self.serialize_cart(reference)
+
+    def update_cart_item(self, reference, item_id, query, payload):
+        with self._lock:
+            for item in self.carts.get(reference, {}).values():
+                if item['id'] == item_id:
+                    item['quantity'] = payload['data']['quantity']
+            return 200, self.serialize_cart(reference)
+
+    def remove_from_cart(self, reference, item_id, query, payload):
+        with self._lock:
+            cart = self.carts.get(reference, {})
+            for product_id, item in list(cart.items()):
+                if item['id'] == item_id:
+                    del cart[product_id]
+            return 200, self.serialize_cart(reference)
+
+    def get_entries(self, flow_slug, query, payload):
+        with self._lock:
+            entries = list(self.flows[flow_slug].values())
+        return 200, self.paginate(f'/v2/flows/{flow_slug}/entries', entries, query)
+
+    def get_entry(self, flow_slug, entry_id, query, payload):
+        return 200, {'data': self.flows[flow_slug][entry_id]}
+
+    def add_entry(self, flow_slug, query, payload):
+        entry = dict(payload['data'], id=str(uuid4()))
+        with self._lock:
+            self.flows[flow_slug][entry['id']] = entry
+        return 201, {'data': entry}
+
+
+class FakeYandexGeocoder(FakeService):
+    routes = [('GET', r'/1\.x/?', 'geocode')]
+
+    def geocode(self, query, payload):
+        longitude = 37.35 + random.random() * 0.5
+        latitude = 55.55 + random.random() * 0.4
+        return 200, {'response': {'GeoObjectCollection': {'featureMember': [
+            {'GeoObject': {'Point': {'pos': f'{longitude} {latitude}'}}}
+        ]}}}
+
+
+class FakeTelegram(FakeService):
+    routes = [('POST', r'/bot[^/]+/(\w+)', 'call_method'), ('GET', r'/bot[^/]+/(\w+)', 'call_method')]
+    bot_user = {'id': 1, 'is_bot': True, 'first_name': 'Pizza bot', 'username': 'pizza_bot'}
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.message_ids = count(1)
+        self.calls = {}
+        self.invoices = {}
+
+    def create_message(self, payload, **fields):
+        chat_id = int(payload.get('chat_id', 0))
+        return dict({
+            'message_id': int(payload.get('message_id') or next(self.message_ids)),
+            'date': int(time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': self.bot_user
+        }, **fields)
+
+    def call_method(self, method, query, payload):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': self.bot_user}
+        if method in ('sendPhoto', 'editMessageMedia'):
+            file_id = uuid4().hex
+            return 200, {'ok': True, 'result': self.create_message(payload, caption=payload.get('caption', ''), photo=[
+                {'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 800}
+            ])}
+        if method == 'sendInvoice':
+            with self._lock:
+                self.invoices[int(payload['chat_id'])] = payload
+        if method in ('sendMessage', 'editMessageText', 'sendInvoice', 'sendLocation'):
+            return 200, {'ok': True, 'result': self.create_message(payload, text=payload.get('text', ''))}
+        if method == 'editMessageCaption':
+            return 200, {'ok': True, 'result': self.create_message(payload, caption=payload.get('caption', ''))}
+        return 200, {'ok': True, 'result': True}
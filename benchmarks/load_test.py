@@ -0,0 +1,249 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import count
+from threading import Lock
+from time import perf_counter, sleep, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_services import FakeMoltin, FakeTelegram, FakeYandexGeocoder  # noqa: E402
+from telegram import Update  # noqa: E402
+
+STEPS = (
+    'menu',
+    'product',
+    'add_to_cart',
+    'cart',
+    'ask_for_address',
+    'address',
+    'delivery',
+    'invoice',
+    'pre_checkout',
+    'payment',
+)
+
+
+class SyntheticCustomer:
+    update_ids = count(1)
+
+    def __init__(self, telegram_user_id, bot, fake_telegram):
+        self.user = {'id': telegram_user_id, 'is_bot': False, 'first_name': f'Customer {telegram_user_id}'}
+        self.chat = {'id': telegram_user_id, 'type': 'private'}
+        self.bot = bot
+        self.fake_telegram = fake_telegram
+        self.message_ids = count(1)
+
+    def create_update(self, **fields):
+        return Update.de_json(dict(fields, update_id=next(self.update_ids)), self.bot)
+
+    def message(self, **fields):
+        return self.create_update(message=dict({
+            'message_id': next(self.message_ids),
+            'date': int(time()),
+            'chat': self.chat,
+            'from': self.user
+        }, **fields))
+
+    def command(self, command):
+        return self.message(text=command, entities=[{'type': 'bot_command', 'offset': 0, 'length': len(command)}])
+
+    def tap(self, callback_data):
+        return self.create_update(callback_query={
+            'id': str(next(self.update_ids)),
+            'from': self.user,
+            'chat_instance': str(self.chat['id']),
+            'data': callback_data,
+            'message': {
+                'message_id': next(self.message_ids),
+                'date': int(time()),
+                'chat': self.chat,
+                'from': FakeTelegram.bot_user,
+                'text': 'Какую пиццу выберешь сегодня?'
+            }
+        })
+
+    def get_invoice(self):
+        invoice = self.fake_telegram.invoices[self.user['id']]
+        prices = invoice['prices']
+        if isinstance(prices, str):
+            prices = json.loads(prices)
+        return {
+            'currency': invoice['currency'],
+            'total_amount': sum(price['amount'] for price in prices),
+            'invoice_payload': invoice['payload']
+        }
+
+    def pre_checkout(self):
+        return self.create_update(pre_checkout_query=dict(
+            self.get_invoice(),
+            id=str(next(self.update_ids)),
+            **{'from': self.user}
+        ))
+
+    def successful_payment(self):
+        charge_id = f'charge-{self.user["id"]}-{next(self.update_ids)}'
+        return self.message(successful_payment={
+            **self.get_invoice(),
+            'telegram_payment_charge_id': charge_id,
+            'provider_payment_charge_id': charge_id
+        })
+
+    def get_updates(self, product_id):
+        return (
+            ('menu', partial(self.command, '/start')),
+            ('product', partial(self.tap, product_id)),
+            ('add_to_cart', partial(self.tap, f'+{product_id}')),
+            ('cart', partial(self.tap, 'cart')),
+            ('ask_for_address', partial(self.tap, 'address')),
+            ('address', partial(self.message, text='Москва, Красная площадь, 1')),
+            ('delivery', partial(self.tap, 'delivery')),
+            ('invoice', partial(self.tap, 'pay')),
+            ('pre_checkout', self.pre_checkout),
+            ('payment', self.successful_payment),
+        )
+
+
+def percentile(latencies, share):
+    if not latencies:
+        return 0
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(share * len(latencies)))]
+
+
+def get_dispatched_customers(storage_filename, timeout):
+    connection = sqlite3.connect(storage_filename)
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline and connection.execute('''
+        SELECT COUNT(*) FROM orders
+        WHERE status = 'pending' AND completed_steps NOT LIKE '%"notify_courier"%'
+    ''').fetchone()[0]:
+        sleep(0.1)
+    dispatched_customers = {
+        customer_telegram_id for customer_telegram_id, in connection.execute('''
+            SELECT json_extract(order_data, '$.customer_telegram_id') FROM orders
+            WHERE completed_steps LIKE '%"notify_courier"%'
+        ''')
+    }
+    connection.close()
+    return dispatched_customers
+
+
+def run_load_test(customers, concurrency, workers, products, pizzerias, latency):
+    fake_moltin = FakeMoltin(products=products, pizzerias=pizzerias, latency=latency).start()
+    fake_geocoder = FakeYandexGeocoder(latency=latency).start()
+    fake_telegram = FakeTelegram(latency=latency).start()
+    working_directory = tempfile.mkdtemp(prefix='pizzabot-load-test-')
+    os.chdir(working_directory)
+    os.environ.update({
+        'TELEGRAM_TOKEN': '123456:load-test',
+        'TELEGRAM_API_URL': f'{fake_telegram.url}/bot',
+        'TELEGRAM_PAYMENT_PROVIDER_TOKEN': 'load-test',
+        'TELEGRAM_GLOBAL_RATE': os.getenv('TELEGRAM_GLOBAL_RATE', '100000'),
+        'TELEGRAM_CHAT_RATE': os.getenv('TELEGRAM_CHAT_RATE', '100000'),
+        'MOLTIN_CLIENT_ID': 'load-test',
+        'MOLTIN_CLIENT_SECRET': 'load-test',
+        'MOLTIN_API_URL': fake_moltin.url,
+        'YANDEX_GEOCODER_API_KEY': 'load-test',
+        'YANDEX_GEOCODER_URL': f'{fake_geocoder.url}/1.x',
+    })
+
+    from main import create_dispatcher
+
+    dispatcher = create_dispatcher(workers)
+    dispatcher.job_queue.start()
+    dispatcher.bot_data['order_dispatch_queue'].start()
+    product_ids = list(fake_moltin.products)
+    latencies = {step: [] for step in STEPS}
+    failures = []
+    handler_errors = {}
+    lock = Lock()
+
+    def record_handler_error(update, context):
+        with lock:
+            handler_errors[update.update_id] = context.error
+
+    dispatcher.add_error_handler(record_handler_error)
+
+    def serve_customer(customer_number):
+        customer = SyntheticCustomer(100000 + customer_number, dispatcher.bot, fake_telegram)
+        for step, create_update in customer.get_updates(product_ids[customer_number % len(product_ids)]):
+            try:
+                update = create_update()
+                started_at = perf_counter()
+                dispatcher.process_update(update).result()
+                with lock:
+                    error = handler_errors.pop(update.update_id, None)
+                if error:
+                    raise error
+            except Exception as error:
+                with lock:
+                    failures.append((step, error))
+                return None
+            with lock:
+                latencies[step].append(perf_counter() - started_at)
+        return customer.user['id']
+
+    started_at = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        paid_customers = set(filter(None, executor.map(serve_customer, range(customers))))
+    dispatched_customers = get_dispatched_customers(os.getenv('STORAGE_FILENAME', 'storage.sqlite3'), timeout=30)
+    elapsed = perf_counter() - started_at
+    completed_orders = len(paid_customers & dispatched_customers & set(fake_telegram.invoices))
+    for customer_telegram_id in sorted(paid_customers - dispatched_customers):
+        failures.append(('dispatch', f'no courier notification for customer {customer_telegram_id}'))
+
+    dispatcher.bot_data['order_dispatch_queue'].stop()
+    dispatcher.job_queue.stop()
+    dispatcher.stop()
+    for fake_service in (fake_moltin, fake_geocoder, fake_telegram):
+        fake_service.stop()
+
+    print(f'{completed_orders} orders in {elapsed:.2f} s: {completed_orders / elapsed:.1f} orders/s')
+    print(f'{"step":<16}{"p50, ms":>10}{"p95, ms":>10}{"p99, ms":>10}')
+    for step in STEPS:
+        print(
+            f'{step:<16}'
+            f'{percentile(latencies[step], 0.5) * 1000:>10.1f}'
+            f'{percentile(latencies[step], 0.95) * 1000:>10.1f}'
+            f'{percentile(latencies[step], 0.99) * 1000:>10.1f}'
+        )
+    print(f'Upstream requests: Moltin {fake_moltin.requests}, '
+          f'geocoder {fake_geocoder.requests}, Telegram {fake_telegram.requests}')
+    for step, error in failures[:10]:
+        print(f'Failed at {step}: {error!r}')
+    if len(failures) > 10:
+        print(f'... and {len(failures) - 10} more failures')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Нагрузочный тест бота на локальных заглушках Moltin, Яндекса и Telegram'
+    )
+    parser.add_argument('--customers', type=int, default=200, help='сколько покупателей оформят заказ')
+    parser.add_argument('--concurrency', type=int, default=20, help='сколько покупателей действуют одновременно')
+    parser.add_argument('--workers', type=int, default=8, help='TELEGRAM_WORKERS бота')
+    parser.add_argument('--products', type=int, default=30, help='число пицц в каталоге')
+    parser.add_argument('--pizzerias', type=int, default=200, help='число пиццерий')
+    parser.add_argument('--latency', type=float, default=20, help='задержка ответа заглушек, мс')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    run_load_test(
+        args.customers,
+        args.concurrency,
+        args.workers,
+        args.products,
+        args.pizzerias,
+        args.latency / 1000
+    )
+
+
+if __name__ == '__main__':
+    main()
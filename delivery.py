@@ -0,0 +1,162 @@
+import math
+from geo_utils import EARTH_RADIUS_KM, HAVERSINE_TOLERANCE
+from geopy import distance
+from threading import Lock
+
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+BLOCK_SIZE = 64
+CELL_RADIUS_MARGIN = 1.01
+OUT_OF_REACH = -1
+AMBIGUOUS = -2
+DELIVERY_TIERS = {
+    'default': [[0.5, 0], [5, 100], [20, 300]]
+}
+
+
+def geodesic_distance(longitude, latitude, pizzeria):
+    return distance.distance((pizzeria['latitude'], pizzeria['longitude']), (latitude, longitude)).km
+
+
+class DeliveryZones:
+    def __init__(self, pizzeria_index, delivery_tiers=DELIVERY_TIERS, cell_size=0.25):
+        self.pizzeria_index = pizzeria_index
+        self.delivery_tiers = delivery_tiers
+        self.cell_size = cell_size
+        self.latitude_step = cell_size / KM_PER_DEGREE
+        self.grid = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def get_tiers(self, pizzeria):
+        return self.delivery_tiers.get(pizzeria.get('city'), self.delivery_tiers['default'])
+
+    def get_tier(self, pizzeria, delivery_distance):
+        for tier in self.get_tiers(pizzeria):
+            if delivery_distance <= tier[0]:
+                return tier
+        return None
+
+    def lookup(self, longitude, latitude):
+        grid = self.grid
+        block = None
+        if grid:
+            pizzeria_index, longitude_step, blocks = grid
+            row, column = math.floor(latitude / self.latitude_step), math.floor(longitude / longitude_step)
+            block = blocks.get((row // BLOCK_SIZE, column // BLOCK_SIZE))
+        if block is not None:
+            tiers, pizzerias, candidate_offsets, candidates = block
+            cell = row % BLOCK_SIZE * BLOCK_SIZE + column % BLOCK_SIZE
+            tier_position = int(tiers[cell])
+        if block is None or tier_position == OUT_OF_REACH:
+            self.misses += 1
+            pizzeria = self.pizzeria_index.nearest(longitude, latitude)[0]
+            return pizzeria, self.get_tier(pizzeria, pizzeria['delivery_distance'])
+        self.hits += 1
+        if tier_position == AMBIGUOUS:
+            ambiguous_cell = int(pizzerias[cell])
+            cell_candidates = candidates[candidate_offsets[ambiguous_cell]:candidate_offsets[ambiguous_cell + 1]]
+        else:
+            cell_candidates = pizzerias[cell:cell + 1]
+        delivery_distance, pizzeria_position = min(
+            (geodesic_distance(longitude, latitude, pizzeria_index.pizzerias[candidate]), candidate)
+            for candidate in cell_candidates.tolist()
+        )
+        pizzeria = dict(pizzeria_index.pizzerias[pizzeria_position], delivery_distance=delivery_distance)
+        if tier_position == AMBIGUOUS:
+            return pizzeria, self.get_tier(pizzeria, delivery_distance)
+        tiers = self.get_tiers(pizzeria)
+        return pizzeria, tiers[tier_position] if tier_position < len(tiers) else None
+
+    def rebuild(self, pizzeria_index):
+        with self._lock:
+            self.pizzeria_index = pizzeria_index
+            self.grid = None
+            self.grid = self.build(pizzeria_index)
+
+    def build(self, pizzeria_index):
+        import numpy as np
+
+        if not len(pizzeria_index):
+            return None
+        pizzeria_index.load_coordinates()
+        pizzeria_tiers = [self.get_tiers(pizzeria) for pizzeria in pizzeria_index.pizzerias]
+        boundaries = np.full((len(pizzeria_tiers), max(len(tiers) for tiers in pizzeria_tiers)), np.inf)
+        for pizzeria_position, tiers in enumerate(pizzeria_tiers):
+            boundaries[pizzeria_position, :len(tiers)] = [max_distance for max_distance, _ in tiers]
+        reach = boundaries[np.isfinite(boundaries)].max() * HAVERSINE_TOLERANCE + self.cell_size
+        search_reach = (reach + self.cell_size) * HAVERSINE_TOLERANCE ** 2 + self.cell_size
+        latitude_step = self.latitude_step
+        longitude_step = latitude_step / max(float(pizzeria_index.cos_latitudes.mean()), 0.01)
+        block_height = latitude_step * BLOCK_SIZE
+        block_width = longitude_step * BLOCK_SIZE
+        pizzeria_latitudes = np.degrees(pizzeria_index.latitudes)
+        pizzeria_longitudes = np.degrees(pizzeria_index.longitudes)
+        latitude_reach = search_reach / KM_PER_DEGREE
+        longitude_scales = 1 / (KM_PER_DEGREE * np.maximum(
+            np.cos(np.radians(np.minimum(np.abs(pizzeria_latitudes) + latitude_reach, 90))),
+            0.01
+        ))
+        longitude_reaches = search_reach * longitude_scales
+
+        block_keys = set()
+        block_reach = reach + self.cell_size
+        for latitude, longitude, longitude_scale in zip(
+            pizzeria_latitudes.tolist(),
+            pizzeria_longitudes.tolist(),
+            longitude_scales.tolist()
+        ):
+            for block_row in range(
+                math.floor((latitude - block_reach / KM_PER_DEGREE) / block_height),
+                math.floor((latitude + block_reach / KM_PER_DEGREE) / block_height) + 1
+            ):
+                for block_column in range(
+                    math.floor((longitude - block_reach * longitude_scale) / block_width),
+                    math.floor((longitude + block_reach * longitude_scale) / block_width) + 1
+                ):
+                    block_keys.add((block_row, block_column))
+
+        blocks = {}
+        offsets = np.arange(BLOCK_SIZE)
+        for block_row, block_column in block_keys:
+            nearby = np.abs(pizzeria_latitudes - (block_row + 0.5) * block_height) <= latitude_reach + block_height / 2
+            nearby &= np.abs(pizzeria_longitudes - (block_column + 0.5) * block_width) <= \
+                longitude_reaches + block_width / 2
+            nearby = np.flatnonzero(nearby)
+            rows = np.repeat(block_row * BLOCK_SIZE + offsets, BLOCK_SIZE)
+            columns = np.tile(block_column * BLOCK_SIZE + offsets, BLOCK_SIZE)
+            latitudes = np.radians((rows + 0.5) * latitude_step)[:, None]
+            longitudes = np.radians((columns + 0.5) * longitude_step)[:, None]
+            a = np.sin((pizzeria_index.latitudes[nearby] - latitudes) / 2) ** 2 + \
+                np.cos(latitudes) * pizzeria_index.cos_latitudes[nearby] * \
+                np.sin((pizzeria_index.longitudes[nearby] - longitudes) / 2) ** 2
+            distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+            cell_radiuses = CELL_RADIUS_MARGIN * np.hypot(
+                self.cell_size,
+                longitude_step * KM_PER_DEGREE * np.cos(latitudes[:, 0])
+            ) / 2
+            nearest = distances.argmin(axis=1)
+            nearest_distances = distances[np.arange(len(distances)), nearest]
+            closest_distances = (distances - cell_radiuses[:, None]) / HAVERSINE_TOLERANCE
+            farthest_distances = (nearest_distances + cell_radiuses) * HAVERSINE_TOLERANCE
+            nearest_closest_distances = closest_distances[np.arange(len(distances)), nearest]
+            candidates = closest_distances <= farthest_distances[:, None]
+            in_reach = nearest_distances - cell_radiuses <= reach
+            if not in_reach.any():
+                continue
+            nearest = nearby[nearest]
+            closest_tiers = (boundaries[nearest] < nearest_closest_distances[:, None]).sum(axis=1)
+            farthest_tiers = (boundaries[nearest] < farthest_distances[:, None]).sum(axis=1)
+            candidate_counts = candidates.sum(axis=1)
+            unambiguous = in_reach & (candidate_counts == 1) & (closest_tiers == farthest_tiers)
+            ambiguous = in_reach & ~unambiguous
+            tiers = np.full(BLOCK_SIZE * BLOCK_SIZE, OUT_OF_REACH, dtype=np.int8)
+            tiers[unambiguous] = closest_tiers[unambiguous]
+            tiers[ambiguous] = AMBIGUOUS
+            pizzerias = np.full(BLOCK_SIZE * BLOCK_SIZE, -1, dtype=np.int32)
+            pizzerias[unambiguous] = nearest[unambiguous]
+            pizzerias[ambiguous] = np.arange(np.count_nonzero(ambiguous))
+            candidate_offsets = np.concatenate(([0], np.cumsum(candidate_counts[ambiguous]))).astype(np.int32)
+            candidate_positions = nearby[np.nonzero(candidates[ambiguous])[1]].astype(np.int32)
+            blocks[(block_row, block_column)] = tiers, pizzerias, candidate_offsets, candidate_positions
+        return pizzeria_index, longitude_step, blocks
@@ -0,0 +1,102 @@
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update
+from telegram.ext import Dispatcher
+from threading import Event, Thread
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedDispatcher(Dispatcher):
+    def __init__(self, *args, shards=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shards = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'shard_{shard}')
+            for shard in range(shards)
+        ]
+
+    def get_shard(self, update):
+        if not isinstance(update, Update) or not update.effective_user:
+            return None
+        return self.shards[update.effective_user.id % len(self.shards)]
+
+    def process_update(self, update):
+        shard = self.get_shard(update)
+        if shard is None:
+            return super().process_update(update)
+        return shard.submit(self.process_sharded_update, update)
+
+    def process_sharded_update(self, update):
+        try:
+            super().process_update(update)
+        except Exception:
+            logger.exception('Failed to process update %s', update.update_id)
+
+    def stop(self):
+        super().stop()
+        for shard in self.shards:
+            shard.shutdown(wait=True)
+
+
+class WorkerPool:
+    def __init__(self, processes, run_worker, *args):
+        self.run_worker = run_worker
+        self.args = args
+        self.context = multiprocessing.get_context('spawn')
+        self.pipes = [self.context.Pipe(duplex=False) for _ in range(processes)]
+        self.processes = [None] * processes
+        self._stopped = Event()
+        self._monitor = None
+
+    def get_shard(self, update):
+        if not update.effective_user:
+            return 0
+        return update.effective_user.id % len(self.processes)
+
+    def route(self, update):
+        _, update_sender = self.pipes[self.get_shard(update)]
+        update_sender.send(update.to_dict())
+
+    def start(self):
+        for shard in range(len(self.processes)):
+            self._start_worker(shard)
+        self._monitor = Thread(target=self._watch, name='worker_monitor', daemon=True)
+        self._monitor.start()
+        return self
+
+    def _start_worker(self, shard):
+        process = self.context.Process(
+            target=self.run_worker,
+            args=(shard, len(self.processes), self.pipes[shard][0], *self.args),
+            name=f'worker_{shard}'
+        )
+        process.start()
+        self.processes[shard] = process
+
+    def _watch(self):
+        while not self._stopped.wait(1):
+            for shard, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error(f'Worker {shard} exited with code {process.exitcode}, restarting it')
+                    self._start_worker(shard)
+
+    def stop(self):
+        self._stopped.set()
+        if self._monitor:
+            self._monitor.join()
+        for _, update_sender in self.pipes:
+            update_sender.send(None)
+        for process in self.processes:
+            process.join()
+
+
+class RoutingDispatcher(Dispatcher):
+    def __init__(self, *args, worker_pool, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker_pool = worker_pool
+
+    def process_update(self, update):
+        if not isinstance(update, Update):
+            return super().process_update(update)
+        self.worker_pool.route(update)
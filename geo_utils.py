@@ -1,23 +1,151 @@
+import json
 import requests
-from geopy import distance
+import sqlite3
+from metrics import metrics
+from threading import Lock
+from time import time
 
+EARTH_RADIUS_KM = 6371.0088
+HAVERSINE_TOLERANCE = 1.012
+GEOCODER_URL = 'https://geocode-maps.yandex.ru/1.x'
 
-def define_delivery_distance(pizzerias, client_longitude, client_latitude):
-    for pizzeria in pizzerias:
-        pizzeria['delivery_distance'] = distance.distance(
-            (pizzeria['latitude'], pizzeria['longitude']),
-            (client_latitude, client_longitude)
-        ).km
 
+class PizzeriaIndex:
+    def __init__(self, pizzerias):
+        self.pizzerias = list(pizzerias)
+        self.latitudes = None
+        self._lock = Lock()
 
-def fetch_coordinates(apikey, address):
-    base_url = 'https://geocode-maps.yandex.ru/1.x'
-    response = requests.get(base_url, params={
-        'geocode': address,
-        'apikey': apikey,
-        'format': 'json',
-    })
-    response.raise_for_status()
+    def __len__(self):
+        return len(self.pizzerias)
+
+    def load_coordinates(self):
+        import numpy as np
+
+        with self._lock:
+            if self.latitudes is not None:
+                return
+            coordinates = np.radians(np.array(
+                [(float(pizzeria['latitude']), float(pizzeria['longitude'])) for pizzeria in self.pizzerias],
+                dtype=float
+            ).reshape(-1, 2))
+            self.longitudes = coordinates[:, 1]
+            self.cos_latitudes = np.cos(coordinates[:, 0])
+            self.latitudes = coordinates[:, 0]
+
+    def haversine_distances(self, longitude, latitude):
+        import numpy as np
+
+        self.load_coordinates()
+        latitude, longitude = np.radians(latitude), np.radians(longitude)
+        a = np.sin((self.latitudes - latitude) / 2) ** 2 + \
+            np.cos(latitude) * self.cos_latitudes * np.sin((self.longitudes - longitude) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+    def nearest(self, longitude, latitude, k=1):
+        import numpy as np
+        from geopy import distance
+
+        if not self.pizzerias:
+            return []
+        k = min(k, len(self.pizzerias))
+        approximate_distances = self.haversine_distances(longitude, latitude)
+        kth_distance = np.partition(approximate_distances, k - 1)[k - 1]
+        candidates = np.flatnonzero(approximate_distances <= kth_distance * HAVERSINE_TOLERANCE + 1e-9)
+        nearest_pizzerias = []
+        for candidate in candidates:
+            pizzeria = dict(self.pizzerias[candidate])
+            pizzeria['delivery_distance'] = distance.distance(
+                (pizzeria['latitude'], pizzeria['longitude']),
+                (latitude, longitude)
+            ).km
+            nearest_pizzerias.append(pizzeria)
+        nearest_pizzerias.sort(key=lambda p: p['delivery_distance'])
+        return nearest_pizzerias[:k]
+
+
+class GeocodingCache:
+    def __init__(self, filename='geocoding.sqlite3', ttl=30 * 24 * 3600, negative_ttl=24 * 3600, max_size=100000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS geocoding (
+                address TEXT PRIMARY KEY,
+                coordinates TEXT,
+                expires_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            )
+        ''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS geocoding_used_at ON geocoding (used_at)')
+        self._connection.commit()
+
+    @staticmethod
+    def normalize(address):
+        return ' '.join(address.lower().replace('ё', 'е').replace(',', ' ').split())
+
+    def get(self, address):
+        address = self.normalize(address)
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT coordinates, expires_at FROM geocoding WHERE address = ?', (address,)
+            ).fetchone()
+            if row is None or row[1] < time():
+                self.misses += 1
+                raise KeyError(address)
+            self._connection.execute('UPDATE geocoding SET used_at = ? WHERE address = ?', (time(), address))
+            self._connection.commit()
+        self.hits += 1
+        return tuple(json.loads(row[0])) if row[0] else None
+
+    def put(self, address, coordinates):
+        ttl = self.ttl if coordinates else self.negative_ttl
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO geocoding VALUES (?, ?, ?, ?)',
+                (self.normalize(address), json.dumps(coordinates) if coordinates else None, time() + ttl, time())
+            )
+            self._puts += 1
+            if self._puts % 100 == 0:
+                self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        self._connection.execute(
+            '''
+            DELETE FROM geocoding WHERE address IN (
+                SELECT address FROM geocoding ORDER BY used_at DESC LIMIT -1 OFFSET ?
+            )
+            ''',
+            (self.max_size,)
+        )
+
+
+def fetch_coordinates(apikey, address, cache=None, timeout=10, base_url=GEOCODER_URL):
+    if cache:
+        try:
+            return cache.get(address)
+        except KeyError:
+            pass
+    coordinates = request_coordinates(apikey, address, timeout, base_url)
+    if cache:
+        cache.put(address, coordinates)
+    return coordinates
+
+
+def request_coordinates(apikey, address, timeout=10, base_url=GEOCODER_URL):
+    with metrics.timed('geocoder_request'):
+        response = requests.get(base_url, params={
+            'geocode': address,
+            'apikey': apikey,
+            'format': 'json',
+        }, timeout=timeout)
+        response.raise_for_status()
     found_places = response.json()['response']['GeoObjectCollection']['featureMember']
 
     if not found_places:
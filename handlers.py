@@ -1,11 +1,22 @@
 import logging
 import requests
 from contextlib import suppress
-from textwrap import dedent
-from geo_utils import define_delivery_distance, fetch_coordinates
-from message_formatters import escape, get_cart_summary, get_product_summary
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
+from functools import partial
+from geo_utils import PizzeriaIndex, fetch_coordinates
+from message_formatters import get_cart_summary, get_product_summary
+from moltin import parse_catalog_product
+from screens import send_photo, show_photo, show_text
+from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    LabeledPrice
+)
 from telegram.constants import PARSEMODE_MARKDOWN_V2
+from telegram.error import BadRequest
+from time import time
+from uuid import uuid4
 
 logger = logging.getLogger(__name__)
 
@@ -19,50 +30,78 @@ logger = logging.getLogger(__name__)
     HANDLE_FINISH
 ) = range(7)
 
+INLINE_RESULTS_PER_PAGE = 50
+
+
+def fetch_product(context, product_id, telegram_user_id):
+    moltin_async_client = context.bot_data.get('moltin_async_client')
+    if moltin_async_client:
+        return moltin_async_client.run(moltin_async_client.get_product(product_id, telegram_user_id))
+    return context.bot_data['moltin_client'].get_product(product_id, telegram_user_id)
+
+
+def show_product_photo(context, message, product, show=show_photo, **kwargs):
+    product_photos = context.bot_data['product_photos']
+    product_photo = product_photos.get(product['id'])
+    if product_photo and product_photo['image_id'] == product['image_id']:
+        try:
+            return show(message, product_photo['file_id'], **kwargs)
+        except BadRequest:
+            product_photos.delete(product['id'])
+    photo_message = show(message, product['image_url'], **kwargs)
+    if photo_message is True:
+        return photo_message
+    product_photos.put(product['id'], {
+        'image_id': product['image_id'],
+        'file_id': photo_message.photo[-1].file_id
+    })
+    return photo_message
+
 
 def start(update, context):
     moltin_client = context.bot_data['moltin_client']
-    products_per_page = context.bot_data['products_per_page']
     all_products = moltin_client.get_all_products()
-    keyboard = []
-    for product in all_products[0:products_per_page]:
-        keyboard.append([InlineKeyboardButton(product['name'], callback_data=product['id'])])
-    keyboard.append([InlineKeyboardButton('Следующие ➡️', callback_data='page1')])
     if update.callback_query:
         update.message = update.callback_query.message
+    elif context.args and moltin_client.get_catalog_product(context.args[0], 0):
+        product = fetch_product(context, context.args[0], update.message.from_user.id)
+        keyboard = []
+        keyboard.append([
+            InlineKeyboardButton('➕ Заказать', callback_data=f'+{product["id"]}'),
+            InlineKeyboardButton('🍕 Корзина', callback_data='cart'),
+            InlineKeyboardButton('🔠 В меню', callback_data='back')
+        ])
+        show_product_photo(
+            context,
+            update.message,
+            product,
+            show=send_photo,
+            caption=get_product_summary(product),
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode=PARSEMODE_MARKDOWN_V2
+        )
+        return HANDLE_PRODUCT
     update.message.reply_text(
         'Какую пиццу выберешь сегодня?',
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=context.bot_data['menu_renderer'].get_keyboard(all_products)
     )
     return HANDLE_MENU
 
 
 def show_menu(update, context):
     moltin_client = context.bot_data['moltin_client']
-    products_per_page = context.bot_data['products_per_page']
     query = update.callback_query
     query.answer()
     page = 0
     if 'page' in query.data:
         page = int(query.data.replace('page', ''))
     all_products = moltin_client.get_all_products()
-    keyboard = []
-    for product in all_products[page * products_per_page:(page + 1) * products_per_page]:
-        keyboard.append([InlineKeyboardButton(product['name'], callback_data=product['id'])])
-    pagination_buttons = []
-    if page > 0:
-        pagination_buttons.append(InlineKeyboardButton('⬅️ Предыдущие', callback_data=f'page{page - 1}'))
-    if len(all_products) > (page + 1) * products_per_page:
-        pagination_buttons.append(InlineKeyboardButton('Следующие ➡️', callback_data=f'page{page + 1}'))
-    keyboard.append(pagination_buttons)
     cart_products, _ = moltin_client.get_cart_data(query.from_user.id)
-    if cart_products:
-        keyboard.append([InlineKeyboardButton('🍕 Корзина', callback_data='cart')])
-    query.message.reply_text(
+    show_text(
+        query.message,
         'Какую пиццу выберешь сегодня?',
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=context.bot_data['menu_renderer'].get_keyboard(all_products, page, show_cart=bool(cart_products))
     )
-    query.message.delete()
     return HANDLE_MENU
 
 
@@ -71,10 +110,15 @@ def show_product(update, context):
     query = update.callback_query
     if '+' in query.data:
         query.data = query.data.replace('+', '')
-        with suppress(requests.exceptions.HTTPError):
-            moltin_client.add_product_to_cart(query.data, 1, query.from_user.id)
+        quantity_in_cart = moltin_client.add_product_to_cart_later(
+            query.data,
+            1,
+            query.from_user.id,
+            on_rejected=partial(reconcile_product_caption, context, query.message, query.data, query.from_user.id)
+        )
         query.answer('Пицца уже в корзине')
-        product = moltin_client.get_product(query.data, query.from_user.id)
+        product = moltin_client.get_catalog_product(query.data, quantity_in_cart) or \
+            fetch_product(context, query.data, query.from_user.id)
         keyboard = []
         keyboard.append([
             InlineKeyboardButton('➕ Заказать', callback_data=f'+{product["id"]}'),
@@ -82,29 +126,41 @@ def show_product(update, context):
             InlineKeyboardButton('🔠 В меню', callback_data='back')
         ])
         query.message.edit_caption(
-            caption=escape(get_product_summary(product)),
+            caption=get_product_summary(product),
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode=PARSEMODE_MARKDOWN_V2
         )
     else:
         query.answer()
-        product = moltin_client.get_product(query.data, query.from_user.id)
+        product = fetch_product(context, query.data, query.from_user.id)
         keyboard = []
         keyboard.append([
             InlineKeyboardButton('➕ Заказать', callback_data=f'+{product["id"]}'),
             InlineKeyboardButton('🍕 Корзина', callback_data='cart'),
             InlineKeyboardButton('🔠 В меню', callback_data='back')
         ])
-        query.message.reply_photo(
-            photo=product['image_url'],
-            caption=escape(get_product_summary(product)),
+        show_product_photo(
+            context,
+            query.message,
+            product,
+            caption=get_product_summary(product),
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode=PARSEMODE_MARKDOWN_V2
         )
-        query.message.delete()
     return HANDLE_PRODUCT
 
 
+def reconcile_product_caption(context, message, product_id, telegram_user_id):
+    product = fetch_product(context, product_id, telegram_user_id)
+    with suppress(BadRequest):
+        message.edit_caption(
+            caption=get_product_summary(product),
+            reply_markup=message.reply_markup,
+            parse_mode=PARSEMODE_MARKDOWN_V2
+        )
+    context.bot.send_message(telegram_user_id, 'Не получилось положить пиццу в корзину, попробуйте ещё раз')
+
+
 def show_cart(update, context):
     moltin_client = context.bot_data['moltin_client']
     query = update.callback_query
@@ -120,22 +176,22 @@ def show_cart(update, context):
             [InlineKeyboardButton(f'Убрать из корзины {product["name"]}', callback_data=product['id'])]
         )
     keyboard.append([InlineKeyboardButton('🔠 В меню', callback_data='back')])
-    query.message.reply_text(
-        escape(get_cart_summary(cart_products, cart_cost)),
+    show_text(
+        query.message,
+        get_cart_summary(cart_products, cart_cost),
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode=PARSEMODE_MARKDOWN_V2
     )
-    query.message.delete()
     return HANDLE_CART
 
 
 def ask_for_address(update, context):
     query = update.callback_query
     query.answer()
-    query.message.reply_text(
+    show_text(
+        query.message,
         'Пожалуйста, введите адрес для оформления заказа или пришлите геолокацию'
     )
-    query.message.delete()
     return AWAIT_LOCATION
 
 
@@ -145,70 +201,78 @@ def handle_location(update, context, coordinates=None):
         longitude, latitude = coordinates
     else:
         longitude, latitude = update.message.location.longitude, update.message.location.latitude
-    moltin_client.add_entry_to_flow('customer_address', {
+    customer_location = {
         'customer_telegram_id': update.message.from_user.id,
         'longitude': longitude,
         'latitude': latitude
-    })
-    pizzerias = moltin_client.get_pizzerias()
-    define_delivery_distance(pizzerias, longitude, latitude)
-    nearest_pizzeria = min(pizzerias, key=lambda p: p['delivery_distance'])
+    }
+    context.bot_data['customer_locations'].put(update.message.from_user.id, customer_location)
+    context.dispatcher.run_async(mirror_customer_location, moltin_client, context.user_data, customer_location)
+    nearest_pizzeria, delivery_tier = context.bot_data['delivery_zones'].lookup(longitude, latitude)
     context.user_data['nearest_pizzeria'] = nearest_pizzeria
+    context.user_data['delivery_tier'] = delivery_tier
+    delivery_distance = nearest_pizzeria['delivery_distance']
+    if delivery_distance < 1:
+        delivery_distance_text = f'{delivery_distance * 1000:.0f} м'
+    else:
+        delivery_distance_text = f'{delivery_distance:.0f} км'
     keyboard = []
-    if nearest_pizzeria['delivery_distance'] <= 0.5:
-        keyboard.append([
-            InlineKeyboardButton('🚶 Заберу сам', callback_data='pickup'),
-            InlineKeyboardButton('🚴 Бесплатная доставка', callback_data='free_delivery')
-        ])
-        keyboard.append([InlineKeyboardButton('🏠 Изменить адрес', callback_data='address')])
-        update.message.reply_text(
-            f'Ближайшая пиццерия по адресу {nearest_pizzeria["address"]} '
-            f'всего в {nearest_pizzeria["delivery_distance"] * 1000:.0f} м от вас. '
-            f'Можем доставить бесплатно!',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    elif nearest_pizzeria['delivery_distance'] <= 5:
+    if delivery_tier is None:
         keyboard.append([
             InlineKeyboardButton('🚗 Заберу сам', callback_data='pickup'),
-            InlineKeyboardButton('🚴 Доставка за 100 ₽', callback_data='paid_delivery_1')
+            InlineKeyboardButton('🏠 Изменить адрес', callback_data='address')
         ])
-        keyboard.append([InlineKeyboardButton('🏠 Изменить адрес', callback_data='address')])
         update.message.reply_text(
-            f'Ближайшая пиццерия по адресу {nearest_pizzeria["address"]} '
-            f'находится в {nearest_pizzeria["delivery_distance"]:.0f} км от вас. '
-            f'Выберите доставку или самовывоз.',
+            f'Ближайшая пиццерия находится в {delivery_distance_text} от вас! '
+            f'Заберёте пиццу сами?',
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
-    elif nearest_pizzeria['delivery_distance'] <= 20:
-        keyboard.append([
-            InlineKeyboardButton('🚗 Заберу сам', callback_data='pickup'),
-            InlineKeyboardButton('🚚 Доставка за 300 ₽', callback_data='paid_delivery_2')
-        ])
-        keyboard.append([InlineKeyboardButton('🏠 Изменить адрес', callback_data='address')])
-        update.message.reply_text(
+        return HANDLE_DELIVERY
+    _, delivery_cost = delivery_tier
+    tier_position = context.bot_data['delivery_zones'].get_tiers(nearest_pizzeria).index(delivery_tier)
+    if delivery_cost:
+        delivery_button = InlineKeyboardButton(
+            f'{"🚴" if tier_position <= 1 else "🚚"} Доставка за {delivery_cost} ₽',
+            callback_data='delivery'
+        )
+        message = (
             f'Ближайшая пиццерия по адресу {nearest_pizzeria["address"]} '
-            f'находится в {nearest_pizzeria["delivery_distance"]:.0f} км от вас. '
-            f'Выберите доставку или самовывоз.',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            f'находится в {delivery_distance_text} от вас. '
+            f'Выберите доставку или самовывоз.'
         )
     else:
-        keyboard.append([
-            InlineKeyboardButton('🚗 Заберу сам', callback_data='pickup'),
-            InlineKeyboardButton('🏠 Изменить адрес', callback_data='address')
-        ])
-        update.message.reply_text(
-            f'Ближайшая пиццерия находится в {nearest_pizzeria["delivery_distance"]:.0f} км от вас! '
-            f'Заберёте пиццу сами?',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+        delivery_button = InlineKeyboardButton('🚴 Бесплатная доставка', callback_data='delivery')
+        message = (
+            f'Ближайшая пиццерия по адресу {nearest_pizzeria["address"]} '
+            f'всего в {delivery_distance_text} от вас. '
+            f'Можем доставить бесплатно!'
         )
+    keyboard.append([
+        InlineKeyboardButton('🚶 Заберу сам' if tier_position == 0 else '🚗 Заберу сам', callback_data='pickup'),
+        delivery_button
+    ])
+    keyboard.append([InlineKeyboardButton('🏠 Изменить адрес', callback_data='address')])
+    update.message.reply_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
     return HANDLE_DELIVERY
 
 
+def mirror_customer_location(moltin_client, user_data, customer_location):
+    user_data['customer_location_entry_id'] = moltin_client.add_entry_to_flow(
+        'customer_address',
+        dict(customer_location)
+    )
+
+
 def handle_address(update, context):
     yandex_geocoder_api_key = context.bot_data['yandex_geocoder_api_key']
     address = update.message.text
     try:
-        coordinates = fetch_coordinates(yandex_geocoder_api_key, address)
+        coordinates = fetch_coordinates(
+            yandex_geocoder_api_key,
+            address,
+            context.bot_data['geocoding_cache'],
+            base_url=context.bot_data['yandex_geocoder_url']
+        )
     except requests.exceptions.RequestException:
         coordinates = None
     if not coordinates:
@@ -225,53 +289,104 @@ def handle_delivery(update, context):
     context.user_data['delivery_type'] = query.data
     keyboard = []
     keyboard.append([InlineKeyboardButton('💳 Оплатить', callback_data='pay')])
-    query.message.reply_text(
+    show_text(
+        query.message,
         'Приготовьте данные вашей карты',
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
-    query.message.delete()
     return HANDLE_PAYMENT
 
 
-def handle_payment(update, context):
-    moltin_client = context.bot_data['moltin_client']
-    delivery_type = context.user_data['delivery_type']
-    token = context.bot_data['payment_provider_token']
-    query = update.callback_query
-    query.answer()
-    cart_products, _ = moltin_client.get_cart_data(query.from_user.id)
+def create_checkout_order(context, telegram_user_id):
+    cart_products, cart_cost = context.bot_data['moltin_client'].get_cart_data(telegram_user_id)
     prices = []
     for product in cart_products:
+        label = product['name']
         if product['quantity'] > 1:
-            product['name'] += f' ({product["quantity"]} шт.)'
-        product['total_cost'] = int(product['total_cost'].replace(' ₽', ''))
-        prices.append(LabeledPrice(product['name'], product['total_cost'] * 100))
+            label += f' ({product["quantity"]} шт.)'
+        prices.append([label, product['amount'] * 100])
+    nearest_pizzeria = context.user_data['nearest_pizzeria']
+    delivery_type = context.user_data['delivery_type']
+    delivery_tier = None
     if delivery_type != 'pickup':
-        if delivery_type == 'free_delivery':
-            delivery_cost = 0
-        elif delivery_type == 'paid_delivery_1':
-            delivery_cost = 100
+        if 'delivery_tier' in context.user_data:
+            delivery_tier = context.user_data['delivery_tier']
         else:
-            delivery_cost = 300
-        prices.append(LabeledPrice('Доставка', delivery_cost * 100))
-    context.bot.send_invoice(query.from_user.id, 'Оплата пиццы', ' ', 'pizzabot_payment', token, 'RUB', prices)
+            delivery_tier = context.bot_data['delivery_zones'].get_tier(
+                nearest_pizzeria,
+                nearest_pizzeria['delivery_distance']
+            )
+        if delivery_tier:
+            _, delivery_cost = delivery_tier
+            prices.append(['Доставка', delivery_cost * 100])
+    return {
+        'invoice_payload': uuid4().hex,
+        'customer_telegram_id': telegram_user_id,
+        'cart_products': cart_products,
+        'cart_cost': cart_cost,
+        'prices': prices,
+        'currency': 'RUB',
+        'total_amount': sum(amount for _, amount in prices),
+        'delivery_type': delivery_type,
+        'delivery_tier': delivery_tier,
+        'pizzeria_id': nearest_pizzeria['id'],
+        'pizzeria_address': nearest_pizzeria['address'],
+        'customer_location': context.bot_data['customer_locations'].get(telegram_user_id),
+        'customer_location_entry_id': context.user_data.get('customer_location_entry_id'),
+        'created_at': time()
+    }
+
+
+def handle_payment(update, context):
+    checkout_orders = context.bot_data['checkout_orders']
+    token = context.bot_data['payment_provider_token']
+    query = update.callback_query
+    query.answer()
+    checkout_order = create_checkout_order(context, query.from_user.id)
+    checkout_orders.put(checkout_order['invoice_payload'], checkout_order)
+    previous_invoice_payload = context.user_data.get('invoice_payload')
+    if previous_invoice_payload:
+        checkout_orders.delete(previous_invoice_payload)
+    context.user_data['invoice_payload'] = checkout_order['invoice_payload']
+    context.bot.send_invoice(
+        query.from_user.id,
+        'Оплата пиццы',
+        ' ',
+        checkout_order['invoice_payload'],
+        token,
+        checkout_order['currency'],
+        [LabeledPrice(label, amount) for label, amount in checkout_order['prices']]
+    )
     return HANDLE_PAYMENT
 
 
 def handle_precheckout(update, context):
     query = update.pre_checkout_query
-    if query.invoice_payload != 'pizzabot_payment':
+    checkout_order = context.bot_data['checkout_orders'].get(query.invoice_payload)
+    if not checkout_order or (
+        checkout_order['customer_telegram_id'],
+        checkout_order['currency'],
+        checkout_order['total_amount']
+    ) != (query.from_user.id, query.currency, query.total_amount):
         query.answer(ok=False, error_message='В процессе оплаты произошла ошибка')
     else:
+        if context.user_data.get('invoice_payload') == query.invoice_payload:
+            del context.user_data['invoice_payload']
         query.answer(ok=True)
     return HANDLE_PAYMENT
 
 
 def handle_successful_payment(update, context):
-    moltin_client = context.bot_data['moltin_client']
-    nearest_pizzeria = context.user_data['nearest_pizzeria']
-    if context.user_data['delivery_type'] == 'pickup':
-        message = f'Спасибо за оплату! Ждём вас в пиццерии по адресу {nearest_pizzeria["address"]}'
+    successful_payment = update.message.successful_payment
+    if context.bot_data['order_dispatch_queue'].has_order(successful_payment.telegram_payment_charge_id):
+        return HANDLE_FINISH
+    checkout_orders = context.bot_data['checkout_orders']
+    checkout_order = checkout_orders.get(successful_payment.invoice_payload)
+    if checkout_order is None:
+        logger.error(f'No checkout order for paid invoice {successful_payment.invoice_payload}, using the cart')
+        checkout_order = create_checkout_order(context, update.message.from_user.id)
+    if checkout_order['delivery_type'] == 'pickup':
+        message = f'Спасибо за оплату! Ждём вас в пиццерии по адресу {checkout_order["pizzeria_address"]}'
     else:
         message = 'Спасибо за оплату! Ждите нашего курьера.'
     keyboard = []
@@ -280,32 +395,80 @@ def handle_successful_payment(update, context):
         message,
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
-    deliveryman_telegram_id = moltin_client.get_deliveryman_telegram_id(nearest_pizzeria['id'])
-    user_id = update.message.from_user.id
-    cart_products, cart_cost = moltin_client.get_cart_data(user_id)
-    customer_location = moltin_client.get_customer_location(user_id)
-    context.bot.send_message(
-        deliveryman_telegram_id,
-        escape(get_cart_summary(cart_products, cart_cost)),
-        parse_mode=PARSEMODE_MARKDOWN_V2
-    )
-    context.bot.send_location(
-        deliveryman_telegram_id,
-        longitude=customer_location['longitude'],
-        latitude=customer_location['latitude']
-    )
-    moltin_client.empty_cart(user_id)
-    context.job_queue.run_once(notify_after_delivery_expiration, 3600, context=user_id)
+    context.bot_data['order_dispatch_queue'].enqueue(successful_payment.telegram_payment_charge_id, {
+        'customer_telegram_id': checkout_order['customer_telegram_id'],
+        'pizzeria_id': checkout_order['pizzeria_id'],
+        'cart_products': checkout_order['cart_products'],
+        'cart_cost': checkout_order['cart_cost'],
+        'customer_location': checkout_order['customer_location'],
+        'customer_location_entry_id': checkout_order['customer_location_entry_id']
+    })
+    checkout_orders.delete(successful_payment.invoice_payload)
+    if context.user_data.get('invoice_payload') == successful_payment.invoice_payload:
+        del context.user_data['invoice_payload']
     return HANDLE_FINISH
 
 
-def notify_after_delivery_expiration(context):
-    message = '''\
-        Приятного аппетита! *место для рекламы*
+def handle_inline_query(update, context):
+    query = update.inline_query
+    offset = int(query.offset or 0)
+    products = context.bot_data['product_search_index'].search(
+        context.bot_data['moltin_client'].get_all_products(),
+        query.query
+    )
+    results = []
+    for moltin_product in products[offset:offset + INLINE_RESULTS_PER_PAGE]:
+        product = parse_catalog_product(moltin_product, 0)
+        keyboard = []
+        keyboard.append([
+            InlineKeyboardButton('➕ Заказать', url=f'https://t.me/{context.bot.username}?start={product["id"]}')
+        ])
+        results.append(InlineQueryResultArticle(
+            id=product['id'],
+            title=product['name'],
+            description=f'{product["price"]} · {product["description"]}',
+            thumb_url=moltin_product.get('image_url'),
+            input_message_content=InputTextMessageContent(
+                get_product_summary(product),
+                parse_mode=PARSEMODE_MARKDOWN_V2
+            ),
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        ))
+    next_offset = ''
+    if offset + INLINE_RESULTS_PER_PAGE < len(products):
+        next_offset = str(offset + INLINE_RESULTS_PER_PAGE)
+    query.answer(results, next_offset=next_offset)
+
 
-        *сообщение что делать, если пицца не пришла*
-        '''
-    context.bot.send_message(
-        context.job.context,
-        dedent(message)
+def purge_checkout_orders(context):
+    purged = context.bot_data['checkout_orders'].delete_older_than(
+        'created_at',
+        time() - context.bot_data['checkout_order_ttl']
     )
+    if purged:
+        logger.info(f'Purged {purged} unpaid checkout orders')
+
+
+def refresh_pizzeria_index(context):
+    moltin_client = context.bot_data['moltin_client']
+    try:
+        pizzerias = moltin_client.get_pizzerias()
+    except requests.exceptions.RequestException:
+        logger.exception('Failed to refresh pizzerias, keeping the previous index')
+        return
+    delivery_zones = context.bot_data['delivery_zones']
+    if pizzerias != context.bot_data['pizzeria_index'].pizzerias:
+        context.bot_data['pizzeria_index'] = PizzeriaIndex(pizzerias)
+        context.bot_data['snapshot'].put('pizzerias', pizzerias)
+    elif delivery_zones.grid is not None:
+        return
+    delivery_zones.rebuild(context.bot_data['pizzeria_index'])
+
+
+def refresh_catalog(context):
+    try:
+        all_products = context.bot_data['moltin_client'].get_all_products()
+    except requests.exceptions.RequestException:
+        logger.exception('Failed to warm up catalog')
+        return
+    context.bot_data['product_search_index'].rebuild(all_products)
@@ -1,17 +1,36 @@
+import json
 import logging
+import multiprocessing
 import os
+import signal
+from delivery import DELIVERY_TIERS, DeliveryZones
+from dispatching import RoutingDispatcher, ShardedDispatcher, WorkerPool
 from dotenv import load_dotenv
+from queue import Queue
+from telegram import Update
 from telegram.ext import (
     CallbackQueryHandler,
     CommandHandler,
     ConversationHandler,
+    ExtBot,
+    InlineQueryHandler,
+    JobQueue,
     MessageHandler,
-    PicklePersistence,
     PreCheckoutQueryHandler,
     Updater,
     Filters,
 )
-from moltin import MoltinClient
+from telegram.utils.request import Request
+from geo_utils import GEOCODER_URL, GeocodingCache, PizzeriaIndex
+from menu import MenuRenderer
+from metrics import metrics
+from moltin import MOLTIN_API_URL, CatalogCache, MoltinClient
+from moltin_async import AsyncMoltinClient
+from order_dispatch import OrderDispatchQueue
+from outbound import ScheduledBot, SendScheduler
+from persistence import SQLitePersistence
+from search import ProductSearchIndex
+from storage import KeyValueStore
 from handlers import (
     HANDLE_MENU,
     HANDLE_PRODUCT,
@@ -27,29 +46,45 @@ from handlers import (
     ask_for_address,
     handle_address,
     handle_delivery,
+    handle_inline_query,
     handle_location,
     handle_payment,
     handle_precheckout,
-    handle_successful_payment
+    handle_successful_payment,
+    purge_checkout_orders,
+    refresh_catalog,
+    refresh_pizzeria_index
 )
 
 logger = logging.getLogger(__name__)
 
+CHECKOUT_ORDERS_PURGE_INTERVAL = 3600
+STATE_NAMES = {
+    HANDLE_MENU: 'HANDLE_MENU',
+    HANDLE_PRODUCT: 'HANDLE_PRODUCT',
+    HANDLE_CART: 'HANDLE_CART',
+    AWAIT_LOCATION: 'AWAIT_LOCATION',
+    HANDLE_DELIVERY: 'HANDLE_DELIVERY',
+    HANDLE_PAYMENT: 'HANDLE_PAYMENT',
+    HANDLE_FINISH: 'HANDLE_FINISH',
+}
 
-def main():
-    load_dotenv()
 
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+def instrument_handlers(conv_handler):
+    handlers_by_state = [('START', conv_handler.entry_points)] + [
+        (STATE_NAMES[state], handlers) for state, handlers in conv_handler.states.items()
+    ]
+    for state_name, handlers in handlers_by_state:
+        for handler in handlers:
+            handler.callback = metrics.instrument(
+                handler.callback,
+                'handler',
+                state=state_name,
+                handler=handler.callback.__name__
+            )
 
-    updater = Updater(
-        os.getenv('TELEGRAM_TOKEN'),
-        persistence=PicklePersistence(filename='conversationbot')
-    )
-    dispatcher = updater.dispatcher
 
+def create_conversation_handler():
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
@@ -85,22 +120,209 @@ def main():
             ],
         },
         fallbacks=[],
+        allow_reentry=True,
         name='pizzabot_conversation',
         persistent=True
     )
+    instrument_handlers(conv_handler)
+    return conv_handler
+
+
+def create_dispatcher(workers, shard=0, shards=1):
+    moltin_timeout = float(os.getenv('MOLTIN_TIMEOUT', 10))
+    storage_filename = os.getenv('STORAGE_FILENAME', 'storage.sqlite3')
+    snapshot = KeyValueStore(storage_filename, 'snapshot')
+    persistence = SQLitePersistence(os.getenv('PERSISTENCE_FILENAME', 'conversationbot.sqlite3'))
+    persistence.migrate_from_pickle('conversationbot')
+    bot = ScheduledBot(
+        os.getenv('TELEGRAM_TOKEN'),
+        base_url=os.getenv('TELEGRAM_API_URL'),
+        request=Request(con_pool_size=2 * workers + 4),
+        send_scheduler=SendScheduler(
+            global_rate=int(os.getenv('TELEGRAM_GLOBAL_RATE', 30)) / shards,
+            chat_rate=float(os.getenv('TELEGRAM_CHAT_RATE', 1)),
+            senders=workers
+        )
+    )
+    dispatcher = ShardedDispatcher(
+        bot,
+        Queue(),
+        job_queue=JobQueue(),
+        persistence=persistence,
+        workers=workers,
+        shards=workers
+    )
+    dispatcher.job_queue.set_dispatcher(dispatcher)
 
     dispatcher.bot_data['moltin_client'] = MoltinClient(
         os.getenv('MOLTIN_CLIENT_ID'),
-        os.getenv('MOLTIN_CLIENT_SECRET')
+        os.getenv('MOLTIN_CLIENT_SECRET'),
+        CatalogCache(
+            ttl=int(os.getenv('MOLTIN_CATALOG_TTL', 600)),
+            stale_ttl=int(os.getenv('MOLTIN_CATALOG_STALE_TTL', 3600)),
+            snapshot=snapshot
+        ),
+        pool_size=workers,
+        timeout=moltin_timeout,
+        api_url=os.getenv('MOLTIN_API_URL', MOLTIN_API_URL),
+        snapshot=snapshot,
+        cart_write_delay=float(os.getenv('MOLTIN_CART_WRITE_DELAY', 0.5))
+    )
+    dispatcher.bot_data['moltin_async_client'] = AsyncMoltinClient(
+        dispatcher.bot_data['moltin_client'],
+        pool_size=workers,
+        timeout=moltin_timeout
     )
     dispatcher.bot_data['payment_provider_token'] = os.getenv('TELEGRAM_PAYMENT_PROVIDER_TOKEN')
     dispatcher.bot_data['yandex_geocoder_api_key'] = os.getenv('YANDEX_GEOCODER_API_KEY')
-    dispatcher.bot_data['products_per_page'] = 5
-    dispatcher.add_handler(conv_handler)
-    dispatcher.add_handler(PreCheckoutQueryHandler(handle_precheckout))
+    dispatcher.bot_data['yandex_geocoder_url'] = os.getenv('YANDEX_GEOCODER_URL', GEOCODER_URL)
+    dispatcher.bot_data['geocoding_cache'] = GeocodingCache(
+        os.getenv('GEOCODING_CACHE_FILENAME', 'geocoding.sqlite3'),
+        ttl=int(os.getenv('GEOCODING_CACHE_TTL', 30 * 24 * 3600))
+    )
+    dispatcher.bot_data['menu_renderer'] = MenuRenderer(products_per_page=5)
+    dispatcher.bot_data['product_search_index'] = ProductSearchIndex()
+    dispatcher.bot_data['snapshot'] = snapshot
+    dispatcher.bot_data['customer_locations'] = KeyValueStore(storage_filename, 'customer_locations')
+    dispatcher.bot_data['product_photos'] = KeyValueStore(storage_filename, 'product_photos')
+    dispatcher.bot_data['checkout_orders'] = KeyValueStore(storage_filename, 'checkout_orders')
+    dispatcher.bot_data['checkout_order_ttl'] = int(os.getenv('CHECKOUT_ORDER_TTL', 24 * 3600))
+    dispatcher.bot_data['order_dispatch_queue'] = OrderDispatchQueue(
+        storage_filename,
+        dispatcher.bot,
+        dispatcher.bot_data['moltin_client'],
+        shard=shard,
+        shards=shards
+    )
+    pizzerias = snapshot.get('pizzerias')
+    if pizzerias is None:
+        pizzerias = dispatcher.bot_data['moltin_client'].get_pizzerias()
+        snapshot.put('pizzerias', pizzerias)
+    dispatcher.bot_data['pizzeria_index'] = PizzeriaIndex(pizzerias)
+    dispatcher.bot_data['delivery_zones'] = DeliveryZones(
+        dispatcher.bot_data['pizzeria_index'],
+        json.loads(os.getenv('DELIVERY_TIERS', 'null')) or DELIVERY_TIERS,
+        cell_size=float(os.getenv('DELIVERY_ZONES_CELL_SIZE', 0.25))
+    )
+    dispatcher.job_queue.run_repeating(
+        refresh_pizzeria_index,
+        interval=int(os.getenv('PIZZERIAS_REFRESH_INTERVAL', 600)),
+        first=0
+    )
+    dispatcher.job_queue.run_repeating(purge_checkout_orders, interval=CHECKOUT_ORDERS_PURGE_INTERVAL, first=0)
+    dispatcher.job_queue.run_once(refresh_catalog, 0)
+    dispatcher.add_handler(create_conversation_handler())
+    dispatcher.add_handler(PreCheckoutQueryHandler(
+        metrics.instrument(handle_precheckout, 'handler', state='PRE_CHECKOUT', handler='handle_precheckout')
+    ))
+    dispatcher.add_handler(InlineQueryHandler(
+        metrics.instrument(handle_inline_query, 'handler', state='INLINE_QUERY', handler='handle_inline_query')
+    ))
+    return dispatcher
+
+
+def setup_logging():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+
+def start_metrics_server(dispatcher, port):
+    moltin_client = dispatcher.bot_data['moltin_client']
+    metrics.register_cache('catalog', moltin_client.catalog_cache)
+    metrics.register_cache('cart', moltin_client.cart_cache)
+    metrics.register_gauge('cart_coalesced_mutations_total', lambda: moltin_client.cart_mutations.requests_saved)
+    metrics.register_cache('geocoding', dispatcher.bot_data['geocoding_cache'])
+    metrics.register_cache('delivery_zones', dispatcher.bot_data['delivery_zones'])
+    metrics.register_gauge('order_dispatch_queue_depth', dispatcher.bot_data['order_dispatch_queue'].get_depth)
+    metrics.register_gauge('telegram_send_queue_depth', dispatcher.bot.send_scheduler.get_depth)
+    metrics.register_gauge('telegram_superseded_edits_total', lambda: dispatcher.bot.send_scheduler.superseded)
+    metrics.start_server(port, os.getenv('METRICS_HOST', '127.0.0.1'))
+
+
+def start_receiving_updates(updater):
+    webhook_url = os.getenv('TELEGRAM_WEBHOOK_URL')
+    if webhook_url:
+        webhook_path = '/'.join(filter(None, [
+            os.getenv('TELEGRAM_WEBHOOK_PATH', 'telegram').strip('/'),
+            os.getenv('TELEGRAM_WEBHOOK_SECRET')
+        ]))
+        updater.start_webhook(
+            listen=os.getenv('TELEGRAM_WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.getenv('TELEGRAM_WEBHOOK_PORT', os.getenv('PORT', 8443))),
+            url_path=webhook_path,
+            webhook_url=f'{webhook_url.rstrip("/")}/{webhook_path}'
+        )
+    else:
+        updater.start_polling()
+
+
+def run_worker(shard, shards, update_receiver, workers):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    load_dotenv()
+    setup_logging()
+
+    dispatcher = create_dispatcher(workers, shard, shards)
+    order_dispatch_queue = dispatcher.bot_data['order_dispatch_queue']
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        start_metrics_server(dispatcher, int(metrics_port) + shard)
+    dispatcher.job_queue.start()
+    order_dispatch_queue.start()
+    parent_process = multiprocessing.parent_process()
+    while parent_process.is_alive():
+        try:
+            if not update_receiver.poll(1):
+                continue
+            update = update_receiver.recv()
+        except EOFError:
+            break
+        if update is None:
+            break
+        dispatcher.process_update(Update.de_json(update, dispatcher.bot))
+    order_dispatch_queue.stop()
+    dispatcher.job_queue.stop()
+    dispatcher.stop()
+
+
+def run_router(processes, workers):
+    worker_pool = WorkerPool(processes, run_worker, workers).start()
+    bot = ExtBot(
+        os.getenv('TELEGRAM_TOKEN'),
+        base_url=os.getenv('TELEGRAM_API_URL'),
+        request=Request(con_pool_size=8)
+    )
+    updater = Updater(
+        dispatcher=RoutingDispatcher(bot, Queue(), job_queue=JobQueue(), worker_pool=worker_pool, workers=1),
+        workers=None
+    )
+    start_receiving_updates(updater)
+    updater.idle()
+    worker_pool.stop()
+
+
+def main():
+    load_dotenv()
+    setup_logging()
+
+    workers = int(os.getenv('TELEGRAM_WORKERS', 4))
+    processes = int(os.getenv('WORKER_PROCESSES', 1))
+    if processes > 1:
+        run_router(processes, workers)
+        return
 
-    updater.start_polling()
+    dispatcher = create_dispatcher(workers)
+    updater = Updater(dispatcher=dispatcher, workers=None)
+    order_dispatch_queue = dispatcher.bot_data['order_dispatch_queue']
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        start_metrics_server(dispatcher, int(metrics_port))
+    start_receiving_updates(updater)
+    order_dispatch_queue.start()
     updater.idle()
+    order_dispatch_queue.stop()
 
 
 if __name__ == '__main__':
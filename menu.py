@@ -0,0 +1,45 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from threading import Lock
+
+CART_BUTTON = InlineKeyboardButton('🍕 Корзина', callback_data='cart')
+SEARCH_BUTTON = InlineKeyboardButton('🔍 Поиск', switch_inline_query_current_chat='')
+
+
+class MenuRenderer:
+    def __init__(self, products_per_page=5):
+        self.products_per_page = products_per_page
+        self.products = None
+        self.pages = []
+        self._lock = Lock()
+
+    def get_keyboard(self, products, page=0, show_cart=False):
+        if products is not self.products:
+            self.rebuild(products)
+        pages = self.pages
+        keyboard, keyboard_with_cart = pages[max(0, min(page, len(pages) - 1))]
+        return keyboard_with_cart if show_cart else keyboard
+
+    def rebuild(self, products):
+        with self._lock:
+            if products is self.products:
+                return
+            page_count = max(1, -(-len(products) // self.products_per_page))
+            pages = []
+            for page in range(page_count):
+                keyboard = [
+                    [InlineKeyboardButton(product['name'], callback_data=product['id'])]
+                    for product in products[page * self.products_per_page:(page + 1) * self.products_per_page]
+                ]
+                pagination_buttons = []
+                if page > 0:
+                    pagination_buttons.append(InlineKeyboardButton('⬅️ Предыдущие', callback_data=f'page{page - 1}'))
+                if page < page_count - 1:
+                    pagination_buttons.append(InlineKeyboardButton('Следующие ➡️', callback_data=f'page{page + 1}'))
+                if pagination_buttons:
+                    keyboard.append(pagination_buttons)
+                pages.append((
+                    InlineKeyboardMarkup(keyboard + [[SEARCH_BUTTON]]),
+                    InlineKeyboardMarkup(keyboard + [[SEARCH_BUTTON, CART_BUTTON]])
+                ))
+            self.pages = pages
+            self.products = products
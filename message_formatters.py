@@ -1,32 +1,64 @@
+from functools import lru_cache
 from textwrap import dedent
 
+MARKDOWN_V2_ESCAPES = str.maketrans({char: f'\\{char}' for char in '\\_*[]()~`>#+-=|{}.!'})
+
+CART_ITEM_TEMPLATE = '*{name}* \\(_{description}_\\)\n{quantity} шт\\. на сумму {total_cost}\n\n'
+CART_TOTAL_TEMPLATE = '*К оплате: {cost}*'
+EMPTY_CART_TEXT = 'Здесь пока пусто\\.'
+COURIER_HEADER = '*Новый заказ*\n\n'
+PRODUCT_TEMPLATE = '*{name} / {price}*\n\n_{description}_\n'
+PRODUCT_QUANTITY_TEMPLATE = '\nВ корзине: *{quantity} шт\\.*\n'
+FOLLOW_UP_TEXT = dedent('''\
+    Приятного аппетита! *место для рекламы*
+
+    *сообщение что делать, если пицца не пришла*
+    ''')
+
 
 def escape(s):
-    return s.replace('-', '\-').replace('.', '\.').replace('(', '\(').replace(')', '\)')
+    return str(s).translate(MARKDOWN_V2_ESCAPES)
+
+
+def render_cart_items(products):
+    return ''.join([
+        render_cart_item(product['name'], product['description'], product['quantity'], product['total_cost'])
+        for product in products
+    ])
+
+
+@lru_cache(maxsize=4096)
+def render_cart_item(name, description, quantity, total_cost):
+    return CART_ITEM_TEMPLATE.format(
+        name=escape(name),
+        description=escape(description),
+        quantity=quantity,
+        total_cost=escape(total_cost)
+    )
 
 
 def get_cart_summary(products, cost):
     if not products:
-        return 'Здесь пока пусто.'
-    summary = ''
-    for product in products:
-        summary += f'''\
-            *{product["name"]}* (_{product["description"]}_)
-            {product["quantity"]} шт. на сумму {product["total_cost"]}
-            \n'''
-    summary = dedent(summary) + f'*К оплате: {cost}*'
-    return summary
+        return EMPTY_CART_TEXT
+    return render_cart_items(products) + CART_TOTAL_TEMPLATE.format(cost=escape(cost))
+
+
+def get_courier_message(products, cost):
+    return COURIER_HEADER + get_cart_summary(products, cost)
 
 
 def get_product_summary(product):
-    summary = f'''\
-            *{product["name"]} / {product["price"]}*
+    return render_product_summary(
+        product['name'],
+        product['price'],
+        product['description'],
+        product['quantity_in_cart']
+    )
 
-            _{product["description"]}_
-            '''
-    if product['quantity_in_cart']:
-        summary += f'''\
 
-            В корзине: *{product["quantity_in_cart"]} шт.*
-            '''
-    return dedent(summary)
+@lru_cache(maxsize=4096)
+def render_product_summary(name, price, description, quantity_in_cart):
+    summary = PRODUCT_TEMPLATE.format(name=escape(name), price=escape(price), description=escape(description))
+    if quantity_in_cart:
+        summary += PRODUCT_QUANTITY_TEMPLATE.format(quantity=quantity_in_cart)
+    return summary
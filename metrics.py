@@ -0,0 +1,120 @@
+import re
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+from urllib.parse import urlsplit
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ID_SEGMENT = re.compile(r'(?<=/)(?:\d+|[0-9a-f]{8}-[0-9a-f-]{27})(?=/|$)')
+
+
+def format_labels(labels, **extra_labels):
+    labels = (*labels, *extra_labels.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.histograms = {}
+        self.errors = {}
+        self.gauges = {}
+        self._lock = Lock()
+
+    def observe(self, name, seconds, error=False, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+            bucket = bisect_left(BUCKETS, seconds)
+            if bucket < len(BUCKETS):
+                histogram['buckets'][bucket] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            if error:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def timed(self, name, **labels):
+        if not self.enabled:
+            return nullcontext()
+        return self._timed(name, labels)
+
+    @contextmanager
+    def _timed(self, name, labels):
+        started_at = perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(name, perf_counter() - started_at, error=True, **labels)
+            raise
+        self.observe(name, perf_counter() - started_at, **labels)
+
+    def instrument(self, callback, name, **labels):
+        @wraps(callback)
+        def instrumented_callback(*args, **kwargs):
+            if not self.enabled:
+                return callback(*args, **kwargs)
+            with self._timed(name, labels):
+                return callback(*args, **kwargs)
+        return instrumented_callback
+
+    def register_cache(self, cache_name, cache):
+        self.gauges[('cache_hits_total', (('cache', cache_name),))] = lambda: cache.hits
+        self.gauges[('cache_misses_total', (('cache', cache_name),))] = lambda: cache.misses
+        self.gauges[('cache_hit_ratio', (('cache', cache_name),))] = \
+            lambda: cache.hits / (cache.hits + cache.misses) if cache.hits + cache.misses else 0
+
+    def register_gauge(self, name, callback, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = callback
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = {key: dict(histogram, buckets=list(histogram['buckets']))
+                          for key, histogram in self.histograms.items()}
+            errors = dict(self.errors)
+        for (name, labels), histogram in sorted(histograms.items()):
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(BUCKETS, histogram['buckets']):
+                cumulative_count += bucket_count
+                lines.append(f'{name}_seconds_bucket{format_labels(labels, le=upper_bound)} {cumulative_count}')
+            lines.append(f'{name}_seconds_bucket{format_labels(labels, le="+Inf")} {histogram["count"]}')
+            lines.append(f'{name}_seconds_sum{format_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_seconds_count{format_labels(labels)} {histogram["count"]}')
+            lines.append(f'{name}_errors_total{format_labels(labels)} {errors.get((name, labels), 0)}')
+        for (name, labels), callback in sorted(self.gauges.items(), key=lambda gauge: gauge[0]):
+            lines.append(f'{name}{format_labels(labels)} {callback()}')
+        return '\n'.join(lines) + '\n'
+
+    def start_server(self, port, host='127.0.0.1'):
+        self.enabled = True
+        metrics = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+def get_endpoint(url):
+    return ID_SEGMENT.sub(':id', urlsplit(url).path)
+
+
+metrics = Metrics()
@@ -1,23 +1,328 @@
 import requests
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from metrics import get_endpoint, metrics
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from threading import Lock, Thread, Timer
 from time import time
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
+MOLTIN_API_URL = 'https://api.moltin.com'
+MOLTIN_PAGE_LIMIT = 100
 
-class MoltinClient:
-    token = ''
-    token_expiration_timestamp = 0
 
-    def __init__(self, client_id, client_secret):
+class CatalogCache:
+    def __init__(self, ttl=600, stale_ttl=3600, snapshot=None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.snapshot = snapshot
+        self.products = None
+        self.fetched_at = 0
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._refreshing = False
+        if snapshot:
+            self.products = snapshot.get('catalog')
+            if self.products is not None:
+                self.fetched_at = time() - ttl
+
+    def get(self, fetch_products):
+        age = time() - self.fetched_at
+        if self.products is not None and age < self.ttl + self.stale_ttl:
+            self.hits += 1
+            if age >= self.ttl:
+                self._refresh_in_background(fetch_products)
+            return self.products
+        with self._lock:
+            if self.products is not None and time() - self.fetched_at < self.ttl:
+                self.hits += 1
+                return self.products
+            self.misses += 1
+            self._store(fetch_products())
+            return self.products
+
+    def invalidate(self):
+        with self._lock:
+            self.fetched_at = 0
+            self.products = None
+
+    def _store(self, products):
+        if products != self.products:
+            self.products = products
+            self.version += 1
+            if self.snapshot:
+                self.snapshot.put('catalog', products)
+        self.fetched_at = time()
+
+    def _refresh_in_background(self, fetch_products):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        Thread(target=self._refresh, args=(fetch_products,), daemon=True).start()
+
+    def _refresh(self, fetch_products):
+        try:
+            products = fetch_products()
+            with self._lock:
+                self._store(products)
+        except requests.exceptions.RequestException:
+            logger.exception('Failed to refresh catalog, serving stale products')
+        finally:
+            self._refreshing = False
+
+
+catalog_cache = CatalogCache()
+
+
+class CartCache:
+    def __init__(self, ttl=3600, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.carts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def get(self, telegram_user_id):
+        with self._lock:
+            cart = self.carts.get(telegram_user_id)
+            if cart is None or time() - cart['fetched_at'] >= self.ttl:
+                self.misses += 1
+                return None
+            self.carts.move_to_end(telegram_user_id)
+            self.hits += 1
+            return cart
+
+    def put(self, telegram_user_id, moltin_cart):
+        cart_products, total_cart_cost = parse_cart(moltin_cart)
+        cart = {
+            'products': cart_products,
+            'total_cost': total_cart_cost,
+            'quantities': {product['product_id']: product['quantity'] for product in cart_products},
+            'fetched_at': time()
+        }
+        with self._lock:
+            self.carts[telegram_user_id] = cart
+            self.carts.move_to_end(telegram_user_id)
+            while len(self.carts) > self.max_size:
+                self.carts.popitem(last=False)
+        return cart
+
+    def update(self, telegram_user_id, moltin_cart):
+        if moltin_cart and 'meta' in moltin_cart and isinstance(moltin_cart.get('data'), list):
+            self.put(telegram_user_id, moltin_cart)
+        else:
+            self.invalidate(telegram_user_id)
+
+    def invalidate(self, telegram_user_id):
+        with self._lock:
+            self.carts.pop(telegram_user_id, None)
+
+
+class CartMutations:
+    def __init__(self, moltin_client, delay=0.5):
+        self.moltin_client = moltin_client
+        self.delay = delay
+        self.pending = {}
+        self.in_flight = {}
+        self.requests_saved = 0
+        self._timers = {}
+        self._flush_locks = {}
+        self._lock = Lock()
+
+    def add(self, telegram_user_id, product_id, quantity, on_rejected=None):
+        with self._lock:
+            user_mutations = self.pending.setdefault(telegram_user_id, {})
+            if product_id in user_mutations:
+                self.requests_saved += 1
+            pending_quantity, _ = user_mutations.get(product_id, (0, None))
+            user_mutations[product_id] = (pending_quantity + quantity, on_rejected)
+            self._flush_locks.setdefault(telegram_user_id, Lock())
+            if telegram_user_id not in self._timers:
+                timer = self._timers[telegram_user_id] = Timer(self.delay, self.flush, args=(telegram_user_id,))
+                timer.daemon = True
+                timer.start()
+
+    def get_pending_quantity(self, telegram_user_id, product_id):
+        with self._lock:
+            return sum(
+                mutations[telegram_user_id][product_id][0]
+                for mutations in (self.pending, self.in_flight)
+                if product_id in mutations.get(telegram_user_id, {})
+            )
+
+    def flush(self, telegram_user_id):
+        with self._lock:
+            flush_lock = self._flush_locks.get(telegram_user_id)
+        if flush_lock is None:
+            return
+        rejected_callbacks = []
+        with flush_lock:
+            with self._lock:
+                user_mutations = self.pending.pop(telegram_user_id, None)
+                timer = self._timers.pop(telegram_user_id, None)
+                if user_mutations:
+                    self.in_flight[telegram_user_id] = user_mutations
+                elif self._flush_locks.get(telegram_user_id) is flush_lock:
+                    del self._flush_locks[telegram_user_id]
+            if timer:
+                timer.cancel()
+            if not user_mutations:
+                return
+            for product_id, (quantity, on_rejected) in user_mutations.items():
+                try:
+                    self.moltin_client.add_product_to_cart(product_id, quantity, telegram_user_id)
+                except requests.exceptions.RequestException:
+                    logger.warning(f'Moltin rejected {quantity} x {product_id} for cart {telegram_user_id}')
+                    self.moltin_client.cart_cache.invalidate(telegram_user_id)
+                    if on_rejected:
+                        rejected_callbacks.append(on_rejected)
+            with self._lock:
+                self.in_flight.pop(telegram_user_id, None)
+                if telegram_user_id not in self.pending and self._flush_locks.get(telegram_user_id) is flush_lock:
+                    del self._flush_locks[telegram_user_id]
+        for on_rejected in rejected_callbacks:
+            try:
+                on_rejected()
+            except Exception:
+                logger.exception('Failed to reconcile rejected cart mutation')
+
+    def has_pending(self, telegram_user_id):
+        return telegram_user_id in self._flush_locks
+
+
+def parse_cart(moltin_cart):
+    cart_products = [{
+        'id': product['id'],
+        'product_id': product['product_id'],
+        'name': product['name'],
+        'description': product['description'],
+        'price': product['meta']['display_price']['with_tax']['unit']['formatted'],
+        'quantity': product['quantity'],
+        'amount': product['value']['amount'],
+        'total_cost': f'{product["value"]["amount"]} ₽'
+    } for product in moltin_cart['data']]
+    total_cart_cost = moltin_cart['meta']['display_price']['with_tax']['formatted']
+    return (cart_products, total_cart_cost)
+
+
+def parse_product(moltin_product, moltin_file, quantity_in_cart):
+    return {
+        'id': moltin_product['id'],
+        'name': moltin_product['name'],
+        'description': moltin_product['description'],
+        'price': moltin_product['meta']['display_price']['with_tax']['formatted'],
+        'stock': moltin_product['meta']['stock']['level'],
+        'image_id': moltin_file['id'],
+        'image_url': moltin_file['link']['href'],
+        'quantity_in_cart': quantity_in_cart
+    }
+
+
+def parse_catalog_product(moltin_product, quantity_in_cart):
+    return {
+        'id': moltin_product['id'],
+        'name': moltin_product['name'],
+        'description': moltin_product['description'],
+        'price': moltin_product['meta']['display_price']['with_tax']['formatted'],
+        'quantity_in_cart': quantity_in_cart
+    }
+
+
+def get_cart_view(cart):
+    return ([dict(product) for product in cart['products']], cart['total_cost'])
+
+
+def get_next_page(moltin_page, url, params):
+    if not moltin_page['data']:
+        return None
+    links = moltin_page.get('links') or {}
+    if links.get('next') and links['next'] != links.get('current'):
+        return links['next'], None
+    meta = moltin_page.get('meta') or {}
+    page, results = meta.get('page'), meta.get('results')
+    if page and results and page['offset'] + page['limit'] < results['total']:
+        return url, dict(params or {}, **{'page[offset]': page['offset'] + page['limit']})
+    return None
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, *args, timeout=10, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def create_session(pool_size=4, timeout=10, retries=3, backoff_factor=0.3):
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        timeout=timeout,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False
+        )
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class TokenManager:
+    def __init__(
+        self,
+        client_id,
+        client_secret,
+        session,
+        api_url=MOLTIN_API_URL,
+        refresh_margin=60,
+        retry_delay=5,
+        snapshot=None
+    ):
         self.client_id = client_id
+        self.api_url = api_url
         self.client_secret = client_secret
+        self.session = session
+        self.refresh_margin = refresh_margin
+        self.retry_delay = retry_delay
+        self.snapshot = snapshot
+        self.token = ''
+        self.expiration_timestamp = 0
+        self._lock = Lock()
+        self._refresh_timer = None
+        if snapshot:
+            self._load_snapshot()
 
-    def check_token(self):
-        if self.token and time() < self.token_expiration_timestamp:
-            return
-        moltin_oauth_response = requests.post(
-            'https://api.moltin.com/oauth/access_token',
+    def get_token(self):
+        if self.token and time() < self.expiration_timestamp:
+            return self.token
+        with self._lock:
+            if not self.token or time() >= self.expiration_timestamp:
+                self._refresh()
+            return self.token
+
+    def invalidate(self, token):
+        with self._lock:
+            if self.token == token:
+                self.token = ''
+
+    def _refresh(self):
+        moltin_oauth_response = self.session.post(
+            f'{self.api_url}/oauth/access_token',
             data={
                 'client_id': self.client_id,
                 'client_secret': self.client_secret,
@@ -27,26 +332,115 @@ class MoltinClient:
         moltin_oauth_response.raise_for_status()
         moltin_oauth_info = moltin_oauth_response.json()
         self.token = moltin_oauth_info['access_token']
-        self.token_expiration_timestamp = moltin_oauth_info['expires']
+        self.expiration_timestamp = moltin_oauth_info['expires']
+        if self.snapshot:
+            self.snapshot.put('moltin_token', {
+                'client_id': self.client_id,
+                'token': self.token,
+                'expires': self.expiration_timestamp
+            })
+        self._schedule_refresh(max(self.expiration_timestamp - time() - self.refresh_margin, self.retry_delay))
+
+    def _load_snapshot(self):
+        saved_token = self.snapshot.get('moltin_token')
+        if not saved_token or saved_token['client_id'] != self.client_id:
+            return
+        if saved_token['expires'] - time() <= self.refresh_margin:
+            return
+        self.token = saved_token['token']
+        self.expiration_timestamp = saved_token['expires']
+        self._schedule_refresh(self.expiration_timestamp - time() - self.refresh_margin)
+
+    def _schedule_refresh(self, delay):
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+        self._refresh_timer = Timer(delay, self._refresh_in_background)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            try:
+                self._refresh()
+            except requests.exceptions.RequestException:
+                logger.exception('Failed to refresh Moltin token in background')
+                self._schedule_refresh(self.retry_delay)
+
+
+class MoltinClient:
+    def __init__(
+        self,
+        client_id,
+        client_secret,
+        catalog_cache=catalog_cache,
+        pool_size=4,
+        timeout=10,
+        api_url=MOLTIN_API_URL,
+        snapshot=None,
+        cart_write_delay=0.5
+    ):
+        self.api_url = api_url
+        self.catalog_cache = catalog_cache
+        self.cart_cache = CartCache()
+        self.cart_mutations = CartMutations(self, delay=cart_write_delay)
+        self.session = create_session(pool_size=pool_size, timeout=timeout)
+        self.token_manager = TokenManager(client_id, client_secret, self.session, api_url, snapshot=snapshot)
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='moltin_prefetch')
+
+    def request(self, method, url, **kwargs):
+        with metrics.timed('moltin_request', method=method, endpoint=get_endpoint(url)):
+            return self.send_request(method, url, **kwargs)
+
+    def send_request(self, method, url, **kwargs):
+        token = self.token_manager.get_token()
+        moltin_response = self.session.request(method, url, headers={'Authorization': f'Bearer {token}'}, **kwargs)
+        if moltin_response.status_code == 401:
+            self.token_manager.invalidate(token)
+            token = self.token_manager.get_token()
+            moltin_response = self.session.request(method, url, headers={'Authorization': f'Bearer {token}'}, **kwargs)
+        moltin_response.raise_for_status()
+        return moltin_response
+
+    def get_page(self, url, params=None):
+        return self.request('GET', url, params=params).json()
+
+    def iterate(self, path, page_limit=MOLTIN_PAGE_LIMIT, **params):
+        for moltin_page in self.iterate_pages(path, page_limit, **params):
+            yield from moltin_page['data']
+
+    def iterate_pages(self, path, page_limit=MOLTIN_PAGE_LIMIT, **params):
+        url = f'{self.api_url}{path}'
+        params = dict(params, **{'page[limit]': page_limit})
+        moltin_page = self.get_page(url, params)
+        while True:
+            next_page = get_next_page(moltin_page, url, params)
+            if not next_page:
+                yield moltin_page
+                return
+            url, params = next_page
+            next_page_future = self.prefetch_executor.submit(self.get_page, url, params)
+            try:
+                yield moltin_page
+            except GeneratorExit:
+                next_page_future.cancel()
+                raise
+            moltin_page = next_page_future.result()
 
     def add_entry_to_flow(self, flow_slug, entry_data):
-        self.check_token()
         entry_data['type'] = 'entry'
-        moltin_flows_response = requests.post(
-            f'https://api.moltin.com/v2/flows/{flow_slug}/entries',
-            headers={'Authorization': f'{self.token}'},
+        moltin_flows_response = self.request(
+            'POST',
+            f'{self.api_url}/v2/flows/{flow_slug}/entries',
             json={
                 'data': entry_data
             }
         )
-        moltin_flows_response.raise_for_status()
         return moltin_flows_response.json()['data']['id']
 
     def add_product_to_cart(self, product_id, product_quantity, telegram_user_id):
-        self.check_token()
-        moltin_carts_response = requests.post(
-            f'https://api.moltin.com/v2/carts/{telegram_user_id}/items',
-            headers={'Authorization': f'Bearer {self.token}'},
+        moltin_carts_response = self.request(
+            'POST',
+            f'{self.api_url}/v2/carts/{telegram_user_id}/items',
             json={
                 'data': {
                     'id': product_id,
@@ -55,126 +449,128 @@ class MoltinClient:
                 }
             }
         )
-        moltin_carts_response.raise_for_status()
+        self.cart_cache.update(telegram_user_id, moltin_carts_response.json())
+
+    def add_product_to_cart_later(self, product_id, product_quantity, telegram_user_id, on_rejected=None):
+        self.cart_mutations.add(telegram_user_id, product_id, product_quantity, on_rejected)
+        return self.load_cart(telegram_user_id)['quantities'].get(product_id, 0) + \
+            self.cart_mutations.get_pending_quantity(telegram_user_id, product_id)
 
     def empty_cart(self, telegram_user_id):
-        self.check_token()
-        moltin_carts_response = requests.delete(
-            f'https://api.moltin.com/v2/carts/{telegram_user_id}/items/',
-            headers={'Authorization': f'Bearer {self.token}'}
-        )
-        moltin_carts_response.raise_for_status()
+        self.cart_mutations.flush(telegram_user_id)
+        moltin_carts_response = self.request('DELETE', f'{self.api_url}/v2/carts/{telegram_user_id}/items/')
+        self.cart_cache.update(telegram_user_id, moltin_carts_response.json())
 
     def get_all_products(self):
-        self.check_token()
-        moltin_products_response = requests.get(
-            'https://api.moltin.com/v2/products',
-            headers={'Authorization': f'Bearer {self.token}'}
-        )
-        moltin_products_response.raise_for_status()
-        return moltin_products_response.json()['data']
+        return self.catalog_cache.get(self.fetch_all_products)
+
+    def fetch_all_products(self):
+        products = []
+        image_urls = {}
+        for moltin_page in self.iterate_pages('/v2/products', include='main_image'):
+            products.extend(moltin_page['data'])
+            for moltin_file in (moltin_page.get('included') or {}).get('main_images', []):
+                image_urls[moltin_file['id']] = moltin_file['link']['href']
+        for product in products:
+            main_image = (product.get('relationships') or {}).get('main_image') or {}
+            product['image_url'] = image_urls.get((main_image.get('data') or {}).get('id'))
+        return products
+
+    def get_catalog_product(self, product_id, quantity_in_cart):
+        for moltin_product in self.get_all_products():
+            if moltin_product['id'] == product_id:
+                return parse_catalog_product(moltin_product, quantity_in_cart)
+        return None
+
+    def get_cart(self, telegram_user_id):
+        self.cart_mutations.flush(telegram_user_id)
+        return self.load_cart(telegram_user_id)
+
+    def load_cart(self, telegram_user_id):
+        cart = self.cart_cache.get(telegram_user_id)
+        if cart:
+            return cart
+        moltin_carts_response = self.request('GET', f'{self.api_url}/v2/carts/{telegram_user_id}/items')
+        return self.cart_cache.put(telegram_user_id, moltin_carts_response.json())
 
     def get_cart_data(self, telegram_user_id):
-        self.check_token()
-        moltin_carts_response = requests.get(
-            f'https://api.moltin.com/v2/carts/{telegram_user_id}/items',
-            headers={'Authorization': f'Bearer {self.token}'}
-        )
-        moltin_carts_response.raise_for_status()
-        cart_products = [{
-            'id': product['id'],
-            'name': product['name'],
-            'description': product['description'],
-            'price': product['meta']['display_price']['with_tax']['unit']['formatted'],
-            'quantity': product['quantity'],
-            'total_cost': f'{product["value"]["amount"]} ₽'
-        } for product in moltin_carts_response.json()['data']]
-        total_cart_cost = moltin_carts_response.json()['meta']['display_price']['with_tax']['formatted']
-        return (cart_products, total_cart_cost)
-
-    def get_customer_location(self, telegram_user_id):
-        self.check_token()
-        moltin_flows_response = requests.get(
-            'https://api.moltin.com/v2/flows/customer_address/entries',
-            headers={'Authorization': f'Bearer {self.token}'}
-        )
-        moltin_flows_response.raise_for_status()
-        locations = moltin_flows_response.json()['data']
-        for location in locations:
+        return get_cart_view(self.get_cart(telegram_user_id))
+
+    def get_customer_location(self, telegram_user_id, entry_id=None):
+        if entry_id:
+            moltin_flows_response = self.request(
+                'GET',
+                f'{self.api_url}/v2/flows/customer_address/entries/{entry_id}'
+            )
+            return moltin_flows_response.json()['data']
+        for location in self.iterate('/v2/flows/customer_address/entries'):
             if location['customer_telegram_id'] == telegram_user_id:
                 return location
 
     def get_deliveryman_telegram_id(self, pizzeria_id):
-        self.check_token()
-        moltin_flows_response = requests.get(
-            f'https://api.moltin.com/v2/flows/pizzeria/entries/{pizzeria_id}',
-            headers={'Authorization': f'Bearer {self.token}'}
-        )
-        moltin_flows_response.raise_for_status()
+        moltin_flows_response = self.request('GET', f'{self.api_url}/v2/flows/pizzeria/entries/{pizzeria_id}')
         return moltin_flows_response.json()['data']['deliveryman_telegram_id']
 
     def get_pizzerias(self):
-        self.check_token()
-        moltin_flows_response = requests.get(
-            'https://api.moltin.com/v2/flows/pizzeria/entries',
-            headers={'Authorization': f'Bearer {self.token}'}
-        )
-        moltin_flows_response.raise_for_status()
-        return moltin_flows_response.json()['data']
+        return list(self.iterate('/v2/flows/pizzeria/entries'))
 
     def get_product(self, product_id, telegram_user_id):
-        self.check_token()
-        moltin_products_response = requests.get(
-            f'https://api.moltin.com/v2/products/{product_id}',
-            headers={'Authorization': f'Bearer {self.token}'}
+        moltin_products_response = self.request(
+            'GET',
+            f'{self.api_url}/v2/products/{product_id}',
+            params={'include': 'main_image'}
         )
-        moltin_products_response.raise_for_status()
-        moltin_product = moltin_products_response.json()['data']
+        moltin_product = moltin_products_response.json()
 
-        main_image_id = moltin_product['relationships']['main_image']['data']['id']
-        moltin_files_response = requests.get(
-            f'https://api.moltin.com/v2/files/{main_image_id}',
-            headers={'Authorization': f'Bearer {self.token}'}
+        return parse_product(
+            moltin_product['data'],
+            moltin_product['included']['main_images'][0],
+            self.get_product_quantity_in_cart(product_id, telegram_user_id)
         )
-        moltin_files_response.raise_for_status()
-        moltin_file = moltin_files_response.json()['data']
-
-        return {
-            'id': moltin_product['id'],
-            'name': moltin_product['name'],
-            'description': moltin_product['description'],
-            'price': moltin_product['meta']['display_price']['with_tax']['formatted'],
-            'stock': moltin_product['meta']['stock']['level'],
-            'image_url': moltin_file['link']['href'],
-            'quantity_in_cart': self.get_product_quantity_in_cart(moltin_product['name'], telegram_user_id)
-        }
 
-    def get_product_quantity_in_cart(self, product_name, telegram_user_id):
-        self.check_token()
-        moltin_carts_response = requests.get(
-            f'https://api.moltin.com/v2/carts/{telegram_user_id}/items',
-            headers={'Authorization': f'Bearer {self.token}'}
-        )
-        moltin_carts_response.raise_for_status()
-        cart_products = moltin_carts_response.json()['data']
-        for product in cart_products:
-            if product['name'] == product_name:
-                return product['quantity']
-        return 0
+    def get_product_quantity_in_cart(self, product_id, telegram_user_id):
+        return self.get_cart(telegram_user_id)['quantities'].get(product_id, 0)
 
     def remove_product_from_cart(self, product_id, telegram_user_id):
-        self.check_token()
-        moltin_carts_response = requests.delete(
-            f'https://api.moltin.com/v2/carts/{telegram_user_id}/items/{product_id}',
-            headers={'Authorization': f'Bearer {self.token}'}
+        self.cart_mutations.flush(telegram_user_id)
+        moltin_carts_response = self.request(
+            'DELETE',
+            f'{self.api_url}/v2/carts/{telegram_user_id}/items/{product_id}'
         )
-        moltin_carts_response.raise_for_status()
+        self.cart_cache.update(telegram_user_id, moltin_carts_response.json())
+
+    def remove_paid_products(self, paid_products, telegram_user_id):
+        self.cart_mutations.flush(telegram_user_id)
+        self.cart_cache.invalidate(telegram_user_id)
+        cart_products = {product['product_id']: product for product in self.load_cart(telegram_user_id)['products']}
+        for paid_product in paid_products:
+            cart_product = cart_products.get(paid_product['product_id'])
+            if cart_product is None:
+                continue
+            quantity = cart_product['quantity'] - paid_product['quantity']
+            if quantity > 0:
+                moltin_carts_response = self.request(
+                    'PUT',
+                    f'{self.api_url}/v2/carts/{telegram_user_id}/items/{cart_product["id"]}',
+                    json={
+                        'data': {
+                            'id': cart_product['id'],
+                            'type': 'cart_item',
+                            'quantity': quantity
+                        }
+                    }
+                )
+            else:
+                moltin_carts_response = self.request(
+                    'DELETE',
+                    f'{self.api_url}/v2/carts/{telegram_user_id}/items/{cart_product["id"]}'
+                )
+            self.cart_cache.update(telegram_user_id, moltin_carts_response.json())
 
     def save_customer(self, email, telegram_user):
-        self.check_token()
-        moltin_customers_response = requests.post(
-            'https://api.moltin.com/v2/customers',
-            headers={'Authorization': f'Bearer {self.token}'},
+        moltin_customers_response = self.request(
+            'POST',
+            f'{self.api_url}/v2/customers',
             json={
                 'data': {
                     'type': 'customer',
@@ -183,5 +579,4 @@ class MoltinClient:
                 }
             }
         )
-        moltin_customers_response.raise_for_status()
         logger.info(moltin_customers_response.json())
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+from metrics import get_endpoint, metrics
+from moltin import MOLTIN_PAGE_LIMIT, get_cart_view, get_next_page, parse_product
+from threading import Thread
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMoltinClient:
+    def __init__(self, moltin_client, pool_size=4, timeout=10):
+        self.moltin_client = moltin_client
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.client = None
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, name='moltin-async', daemon=True).start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def request(self, method, path, **kwargs):
+        with metrics.timed('moltin_request', method=method, endpoint=get_endpoint(path)):
+            return await self.send_request(method, path, **kwargs)
+
+    async def send_request(self, method, path, **kwargs):
+        if self.client is None:
+            import httpx
+
+            self.client = httpx.AsyncClient(
+                base_url=self.moltin_client.api_url,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                timeout=self.timeout
+            )
+        token = await self.get_token()
+        moltin_response = await self.client.request(
+            method,
+            path,
+            headers={'Authorization': f'Bearer {token}'},
+            **kwargs
+        )
+        if moltin_response.status_code == 401:
+            self.moltin_client.token_manager.invalidate(token)
+            token = await self.get_token()
+            moltin_response = await self.client.request(
+                method,
+                path,
+                headers={'Authorization': f'Bearer {token}'},
+                **kwargs
+            )
+        moltin_response.raise_for_status()
+        return moltin_response.json() if moltin_response.content else None
+
+    async def get_token(self):
+        token_manager = self.moltin_client.token_manager
+        if token_manager.token and time() < token_manager.expiration_timestamp:
+            return token_manager.token
+        return await asyncio.get_running_loop().run_in_executor(None, token_manager.get_token)
+
+    async def iterate(self, path, page_limit=MOLTIN_PAGE_LIMIT, **params):
+        url = path
+        params = dict(params, **{'page[limit]': page_limit})
+        moltin_page = await self.request('GET', url, params=params)
+        while True:
+            next_page = get_next_page(moltin_page, url, params)
+            if not next_page:
+                for entry in moltin_page['data']:
+                    yield entry
+                return
+            url, params = next_page
+            next_page_task = asyncio.ensure_future(self.request('GET', url, params=params))
+            try:
+                for entry in moltin_page['data']:
+                    yield entry
+            except GeneratorExit:
+                next_page_task.cancel()
+                raise
+            moltin_page = await next_page_task
+
+    async def add_entry_to_flow(self, flow_slug, entry_data):
+        entry_data['type'] = 'entry'
+        moltin_flow_entry = await self.request('POST', f'/v2/flows/{flow_slug}/entries', json={'data': entry_data})
+        return moltin_flow_entry['data']['id']
+
+    async def add_product_to_cart(self, product_id, product_quantity, telegram_user_id):
+        moltin_cart = await self.request('POST', f'/v2/carts/{telegram_user_id}/items', json={
+            'data': {
+                'id': product_id,
+                'type': 'cart_item',
+                'quantity': product_quantity
+            }
+        })
+        self.moltin_client.cart_cache.update(telegram_user_id, moltin_cart)
+
+    async def empty_cart(self, telegram_user_id):
+        await self.flush_cart_mutations(telegram_user_id)
+        moltin_cart = await self.request('DELETE', f'/v2/carts/{telegram_user_id}/items/')
+        self.moltin_client.cart_cache.update(telegram_user_id, moltin_cart)
+
+    async def get_all_products(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.moltin_client.get_all_products)
+
+    async def flush_cart_mutations(self, telegram_user_id):
+        if self.moltin_client.cart_mutations.has_pending(telegram_user_id):
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                self.moltin_client.cart_mutations.flush,
+                telegram_user_id
+            )
+
+    async def get_cart(self, telegram_user_id):
+        await self.flush_cart_mutations(telegram_user_id)
+        cart = self.moltin_client.cart_cache.get(telegram_user_id)
+        if cart:
+            return cart
+        moltin_cart = await self.request('GET', f'/v2/carts/{telegram_user_id}/items')
+        return self.moltin_client.cart_cache.put(telegram_user_id, moltin_cart)
+
+    async def get_cart_data(self, telegram_user_id):
+        return get_cart_view(await self.get_cart(telegram_user_id))
+
+    async def get_customer_location(self, telegram_user_id, entry_id=None):
+        if entry_id:
+            return (await self.request('GET', f'/v2/flows/customer_address/entries/{entry_id}'))['data']
+        locations = self.iterate('/v2/flows/customer_address/entries')
+        try:
+            async for location in locations:
+                if location['customer_telegram_id'] == telegram_user_id:
+                    return location
+        finally:
+            await locations.aclose()
+
+    async def get_deliveryman_telegram_id(self, pizzeria_id):
+        moltin_flow_entry = await self.request('GET', f'/v2/flows/pizzeria/entries/{pizzeria_id}')
+        return moltin_flow_entry['data']['deliveryman_telegram_id']
+
+    async def get_pizzerias(self):
+        return [pizzeria async for pizzeria in self.iterate('/v2/flows/pizzeria/entries')]
+
+    async def get_product(self, product_id, telegram_user_id):
+        moltin_product, cart = await asyncio.gather(
+            self.request('GET', f'/v2/products/{product_id}', params={'include': 'main_image'}),
+            self.get_cart(telegram_user_id)
+        )
+        return parse_product(
+            moltin_product['data'],
+            moltin_product['included']['main_images'][0],
+            cart['quantities'].get(product_id, 0)
+        )
+
+    async def get_product_quantity_in_cart(self, product_id, telegram_user_id):
+        return (await self.get_cart(telegram_user_id))['quantities'].get(product_id, 0)
+
+    async def remove_product_from_cart(self, product_id, telegram_user_id):
+        await self.flush_cart_mutations(telegram_user_id)
+        moltin_cart = await self.request('DELETE', f'/v2/carts/{telegram_user_id}/items/{product_id}')
+        self.moltin_client.cart_cache.update(telegram_user_id, moltin_cart)
+
+    async def save_customer(self, email, telegram_user):
+        moltin_customer = await self.request('POST', '/v2/customers', json={
+            'data': {
+                'type': 'customer',
+                'name': f'Telegram user {telegram_user.username} (id {telegram_user.id})',
+                'email': email
+            }
+        })
+        logger.info(moltin_customer)
@@ -0,0 +1,182 @@
+import json
+import logging
+import sqlite3
+from message_formatters import FOLLOW_UP_TEXT, get_courier_message
+from outbound import FOLLOW_UP, NOTIFICATION, send_priority
+from telegram.constants import PARSEMODE_MARKDOWN_V2
+from threading import Event, Lock, Thread
+from time import time
+
+logger = logging.getLogger(__name__)
+
+ORDER_STEPS = ('remove_paid_products', 'notify_courier', 'send_customer_location', 'send_follow_up')
+
+
+class OrderDispatchQueue:
+    def __init__(
+        self,
+        filename,
+        bot,
+        moltin_client,
+        max_attempts=10,
+        retry_delay=10,
+        follow_up_delay=3600,
+        shard=0,
+        shards=1
+    ):
+        self.bot = bot
+        self.moltin_client = moltin_client
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.follow_up_delay = follow_up_delay
+        self.shard = shard
+        self.shards = shards
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._worker = None
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS orders (
+                order_id TEXT PRIMARY KEY,
+                order_data TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                completed_steps TEXT NOT NULL DEFAULT '[]',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0
+            )
+        ''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS orders_pending ON orders (status, next_attempt_at)')
+        self._connection.commit()
+
+    def enqueue(self, order_id, order_data):
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR IGNORE INTO orders (order_id, order_data) VALUES (?, ?)',
+                (order_id, json.dumps(dict(order_data, enqueued_at=time()), ensure_ascii=False))
+            )
+            self._connection.commit()
+        self._wakeup.set()
+
+    def has_order(self, order_id):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT 1 FROM orders WHERE order_id = ?',
+                (order_id,)
+            ).fetchone() is not None
+
+    def get_depth(self):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM orders WHERE status = 'pending' AND next_attempt_at <= ?",
+                (time(),)
+            ).fetchone()[0]
+
+    def start(self):
+        self._worker = Thread(target=self._run, name='order_dispatch', daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._worker:
+            self._worker.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            order = self._get_due_order()
+            if order is None:
+                self._wakeup.wait(timeout=1)
+                self._wakeup.clear()
+                continue
+            with send_priority(NOTIFICATION):
+                self._dispatch(*order)
+
+    def _get_due_order(self):
+        with self._lock:
+            row = self._connection.execute(
+                '''
+                SELECT order_id, order_data, completed_steps, attempts FROM orders
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                AND json_extract(order_data, '$.customer_telegram_id') % ? = ?
+                ORDER BY next_attempt_at LIMIT 1
+                ''',
+                (time(), self.shards, self.shard)
+            ).fetchone()
+        if row is None:
+            return None
+        order_id, order_data, completed_steps, attempts = row
+        return order_id, json.loads(order_data), json.loads(completed_steps), attempts
+
+    def _dispatch(self, order_id, order_data, completed_steps, attempts):
+        try:
+            for step in ORDER_STEPS:
+                if step in completed_steps:
+                    continue
+                due_at = self.get_due_at(step, order_data)
+                if due_at > time():
+                    self._save(order_id, next_attempt_at=due_at)
+                    return
+                getattr(self, step)(order_data)
+                completed_steps.append(step)
+                self._save(order_id, completed_steps=completed_steps)
+        except Exception:
+            attempts += 1
+            logger.exception(f'Failed to dispatch order {order_id}, attempt {attempts}')
+            self._save(
+                order_id,
+                status='failed' if attempts >= self.max_attempts else 'pending',
+                attempts=attempts,
+                next_attempt_at=time() + self.retry_delay * 2 ** (attempts - 1)
+            )
+            return
+        self._save(order_id, status='done')
+
+    def _save(self, order_id, completed_steps=None, **fields):
+        if completed_steps is not None:
+            fields['completed_steps'] = json.dumps(completed_steps)
+        assignments = ', '.join(f'{field} = ?' for field in fields)
+        with self._lock:
+            self._connection.execute(
+                f'UPDATE orders SET {assignments} WHERE order_id = ?',
+                (*fields.values(), order_id)
+            )
+            self._connection.commit()
+
+    def get_due_at(self, step, order_data):
+        if step == 'send_follow_up':
+            return order_data.get('enqueued_at', 0) + self.follow_up_delay
+        return 0
+
+    def get_deliveryman_telegram_id(self, order_data):
+        if 'deliveryman_telegram_id' not in order_data:
+            order_data['deliveryman_telegram_id'] = self.moltin_client.get_deliveryman_telegram_id(
+                order_data['pizzeria_id']
+            )
+        return order_data['deliveryman_telegram_id']
+
+    def notify_courier(self, order_data):
+        self.bot.send_message(
+            self.get_deliveryman_telegram_id(order_data),
+            get_courier_message(order_data['cart_products'], order_data['cart_cost']),
+            parse_mode=PARSEMODE_MARKDOWN_V2
+        )
+
+    def send_customer_location(self, order_data):
+        customer_location = order_data['customer_location'] or self.moltin_client.get_customer_location(
+            order_data['customer_telegram_id'],
+            order_data['customer_location_entry_id']
+        )
+        self.bot.send_location(
+            self.get_deliveryman_telegram_id(order_data),
+            longitude=customer_location['longitude'],
+            latitude=customer_location['latitude']
+        )
+
+    def remove_paid_products(self, order_data):
+        self.moltin_client.remove_paid_products(order_data['cart_products'], order_data['customer_telegram_id'])
+
+    def send_follow_up(self, order_data):
+        with send_priority(FOLLOW_UP):
+            self.bot.send_message(order_data['customer_telegram_id'], FOLLOW_UP_TEXT)
@@ -0,0 +1,214 @@
+import heapq
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from itertools import count
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+from threading import Condition, Thread, local
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE, NOTIFICATION, FOLLOW_UP = range(3)
+
+send_context = local()
+
+
+@contextmanager
+def send_priority(priority):
+    previous_priority = getattr(send_context, 'priority', INTERACTIVE)
+    send_context.priority = priority
+    try:
+        yield
+    finally:
+        send_context.priority = previous_priority
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = monotonic()
+
+    def get_delay(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self.updated_at = now
+
+
+class SendScheduler:
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, senders=4):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.chat_queues = {}
+        self.chat_states = {}
+        self.ready_chats = []
+        self.waiting_chats = []
+        self.coalesced_jobs = {}
+        self.depth = 0
+        self.superseded = 0
+        self._sequence = count()
+        self._condition = Condition()
+        self._executor = ThreadPoolExecutor(max_workers=senders, thread_name_prefix='telegram_send')
+        Thread(target=self._run, name='telegram_send_scheduler', daemon=True).start()
+
+    def get_depth(self):
+        return self.depth
+
+    def submit(self, chat_id, priority, send, *args, **kwargs):
+        future, _ = self.schedule(chat_id, priority, send, args, kwargs)
+        return future
+
+    def schedule(self, chat_id, priority, send, args, kwargs, coalesce_key=None):
+        future = Future()
+        with self._condition:
+            throttled = chat_id in self.chat_queues or bool(self._get_chat_bucket(chat_id).get_delay(monotonic()))
+            if not throttled:
+                coalesce_key = None
+            if coalesce_key is not None:
+                superseded_future = self.coalesced_jobs.get(coalesce_key)
+                if superseded_future is not None and superseded_future.cancel():
+                    self.superseded += 1
+                self.coalesced_jobs[coalesce_key] = future
+            self._push((priority, next(self._sequence), chat_id, send, args, kwargs, future, coalesce_key))
+            self._condition.notify()
+        return future, throttled
+
+    def _push(self, job):
+        chat_id = job[2]
+        chat_queue = self.chat_queues.setdefault(chat_id, [])
+        heapq.heappush(chat_queue, job)
+        self.depth += 1
+        state = self.chat_states.get(chat_id)
+        if state is None:
+            self._schedule(chat_id, monotonic())
+        elif state == 'ready' and chat_queue[0] is job:
+            heapq.heappush(self.ready_chats, (job[0], job[1], chat_id))
+
+    def _get_chat_bucket(self, chat_id):
+        chat_bucket = self.chat_buckets.get(chat_id)
+        if chat_bucket is None:
+            chat_bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return chat_bucket
+
+    def _schedule(self, chat_id, now):
+        chat_delay = self._get_chat_bucket(chat_id).get_delay(now)
+        if chat_delay:
+            self.chat_states[chat_id] = 'waiting'
+            heapq.heappush(self.waiting_chats, (now + chat_delay, chat_id))
+        else:
+            self.chat_states[chat_id] = 'ready'
+            priority, sequence = self.chat_queues[chat_id][0][:2]
+            heapq.heappush(self.ready_chats, (priority, sequence, chat_id))
+
+    def _pop_ready_job(self):
+        now = monotonic()
+        while self.waiting_chats and self.waiting_chats[0][0] <= now:
+            _, chat_id = heapq.heappop(self.waiting_chats)
+            self._schedule(chat_id, now)
+        global_delay = self.global_bucket.get_delay(now)
+        if global_delay:
+            return None, global_delay
+        while self.ready_chats:
+            priority, sequence, chat_id = heapq.heappop(self.ready_chats)
+            chat_queue = self.chat_queues.get(chat_id)
+            if self.chat_states.get(chat_id) != 'ready' or chat_queue[0][:2] != (priority, sequence):
+                continue
+            chat_bucket = self._get_chat_bucket(chat_id)
+            if chat_bucket.get_delay(now):
+                self._schedule(chat_id, now)
+                continue
+            job = heapq.heappop(chat_queue)
+            self.depth -= 1
+            coalesce_key, future = job[7], job[6]
+            if coalesce_key is not None and self.coalesced_jobs.get(coalesce_key) is future:
+                del self.coalesced_jobs[coalesce_key]
+            if chat_queue:
+                self._schedule(chat_id, now)
+            else:
+                del self.chat_queues[chat_id]
+                del self.chat_states[chat_id]
+            if future.cancelled():
+                continue
+            self.global_bucket.take()
+            chat_bucket.take()
+            return job, 0
+        return None, self.waiting_chats[0][0] - now if self.waiting_chats else None
+
+    def _forget_idle_chats(self):
+        idle_since = monotonic() - self.chat_burst / self.chat_rate
+        self.chat_buckets = {
+            chat_id: chat_bucket for chat_id, chat_bucket in self.chat_buckets.items()
+            if chat_bucket.updated_at > idle_since or chat_id in self.chat_queues
+        }
+
+    def _run(self):
+        while True:
+            with self._condition:
+                job, delay = self._pop_ready_job()
+                if job is None:
+                    self._condition.wait(timeout=delay)
+                    continue
+                if len(self.chat_buckets) > 10000:
+                    self._forget_idle_chats()
+            self._executor.submit(self._send, job)
+
+    def _send(self, job):
+        priority, sequence, chat_id, send, args, kwargs, future, coalesce_key = job
+        if not future.running() and not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(send(*args, **kwargs))
+        except RetryAfter as error:
+            logger.warning(f'Flood limit hit for chat {chat_id}, pausing sends for {error.retry_after} s')
+            with self._condition:
+                now = monotonic()
+                self.global_bucket.pause(now, error.retry_after)
+                self._get_chat_bucket(chat_id).pause(now, error.retry_after)
+                self._push(job)
+                self._condition.notify()
+        except Exception as error:
+            future.set_exception(error)
+
+
+def log_failed_send(endpoint, future):
+    if not future.cancelled() and future.exception():
+        logger.warning(f'Failed to send deferred {endpoint}', exc_info=future.exception())
+
+
+class ScheduledBot(ExtBot):
+    def __init__(self, *args, send_scheduler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.send_scheduler = send_scheduler
+
+    def _message(self, endpoint, data, *args, **kwargs):
+        if self.send_scheduler is None:
+            return super()._message(endpoint, data, *args, **kwargs)
+        priority = getattr(send_context, 'priority', INTERACTIVE)
+        coalesce_key = None
+        if priority == INTERACTIVE and endpoint.startswith('editMessage') and data.get('message_id'):
+            coalesce_key = (endpoint, data.get('chat_id'), data['message_id'])
+        future, throttled = self.send_scheduler.schedule(
+            data.get('chat_id'),
+            priority,
+            super()._message,
+            (endpoint, data, *args),
+            kwargs,
+            coalesce_key
+        )
+        if priority != INTERACTIVE or not throttled:
+            return future.result()
+        future.add_done_callback(partial(log_failed_send, endpoint))
+        return True
@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import pickle
+import sqlite3
+from collections import defaultdict
+from telegram.ext import BasePersistence
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class LazyUserData(defaultdict):
+    def __init__(self, load_user_data):
+        super().__init__(dict)
+        self.load_user_data = load_user_data
+
+    def __missing__(self, user_id):
+        user_data = self.load_user_data(user_id)
+        self[user_id] = user_data
+        return user_data
+
+    def __copy__(self):
+        user_data = LazyUserData(self.load_user_data)
+        user_data.update(self)
+        return user_data
+
+    copy = __copy__
+
+
+class LazyConversations(dict):
+    def __init__(self, load_state):
+        super().__init__()
+        self.load_state = load_state
+
+    def get(self, key, default=None):
+        if not super().__contains__(key):
+            state = self.load_state(key)
+            if state is None:
+                return default
+            self[key] = state
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, filename='conversationbot.sqlite3'):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self._lock = Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS user_data (
+                user_id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                state BLOB NOT NULL,
+                PRIMARY KEY (name, key)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        ''')
+        self._connection.commit()
+
+    def load_user_data(self, user_id):
+        with self._lock:
+            row = self._connection.execute('SELECT data FROM user_data WHERE user_id = ?', (user_id,)).fetchone()
+        return pickle.loads(row[0]) if row else {}
+
+    def load_state(self, name, key):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT state FROM conversations WHERE name = ? AND key = ?',
+                (name, json.dumps(key))
+            ).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def get_user_data(self):
+        return LazyUserData(self.load_user_data)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return LazyConversations(lambda key: self.load_state(name, key))
+
+    def update_conversation(self, name, key, new_state):
+        if isinstance(new_state, tuple):
+            return
+        with self._lock:
+            if new_state is None:
+                self._connection.execute(
+                    'DELETE FROM conversations WHERE name = ? AND key = ?',
+                    (name, json.dumps(key))
+                )
+            else:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)',
+                    (name, json.dumps(key), pickle.dumps(new_state))
+                )
+            self._connection.commit()
+
+    def update_user_data(self, user_id, data):
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO user_data VALUES (?, ?)', (user_id, pickle.dumps(data)))
+            self._connection.commit()
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush(self):
+        with self._lock:
+            self._connection.commit()
+
+    def migrate_from_pickle(self, filename):
+        with self._lock:
+            migrated = self._connection.execute(
+                'SELECT value FROM meta WHERE key = ?', (f'migrated_from:{filename}',)
+            ).fetchone()
+        if migrated or not os.path.exists(filename):
+            return
+        with open(filename, 'rb') as pickle_file:
+            pickled_data = pickle.load(pickle_file)
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO user_data VALUES (?, ?)',
+                ((user_id, pickle.dumps(data)) for user_id, data in (pickled_data.get('user_data') or {}).items())
+            )
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)',
+                (
+                    (name, json.dumps(key), pickle.dumps(state))
+                    for name, conversations in (pickled_data.get('conversations') or {}).items()
+                    for key, state in conversations.items()
+                    if state is not None and not isinstance(state, tuple)
+                )
+            )
+            self._connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (f'migrated_from:{filename}', '1'))
+            self._connection.commit()
+        logger.info(f'Migrated conversation data from {filename}')
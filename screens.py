@@ -0,0 +1,48 @@
+from contextlib import suppress
+from telegram import InputMediaPhoto
+from telegram.error import BadRequest
+
+
+def is_not_modified(error):
+    return 'message is not modified' in error.message.lower()
+
+
+def replace_message(message, send, *args, **kwargs):
+    new_message = send(*args, **kwargs)
+    with suppress(BadRequest):
+        message.delete()
+    return new_message
+
+
+def show_text(message, text, **kwargs):
+    if message.text is not None:
+        try:
+            return message.edit_text(text, **kwargs)
+        except BadRequest as error:
+            if is_not_modified(error):
+                return message
+    return replace_message(message, message.reply_text, text, **kwargs)
+
+
+def send_photo(message, photo, **kwargs):
+    return message.reply_photo(photo=photo, **kwargs)
+
+
+def show_photo(message, photo, caption=None, parse_mode=None, reply_markup=None):
+    if message.photo:
+        try:
+            return message.edit_media(
+                media=InputMediaPhoto(photo, caption=caption, parse_mode=parse_mode),
+                reply_markup=reply_markup
+            )
+        except BadRequest as error:
+            if is_not_modified(error):
+                return message
+    return replace_message(
+        message,
+        message.reply_photo,
+        photo=photo,
+        caption=caption,
+        parse_mode=parse_mode,
+        reply_markup=reply_markup
+    )
@@ -0,0 +1,65 @@
+import re
+from collections import Counter
+from threading import Lock
+
+WORD = re.compile(r'\w+')
+NAME_WEIGHT = 2
+DESCRIPTION_WEIGHT = 1
+MAX_PREFIX_LENGTH = 20
+TRIGRAM_MATCH_SHARE = 0.5
+
+
+def tokenize(text):
+    return WORD.findall(str(text or '').lower().replace('ё', 'е'))
+
+
+def get_trigrams(token):
+    token = f'  {token} '
+    return {token[position:position + 3] for position in range(len(token) - 2)}
+
+
+class ProductSearchIndex:
+    def __init__(self):
+        self.index = (None, {}, {})
+        self._lock = Lock()
+
+    def search(self, products, query):
+        if products is not self.index[0]:
+            self.rebuild(products)
+        products, prefixes, trigrams = self.index
+        tokens = tokenize(query)
+        if not tokens:
+            return list(products)
+        scores = None
+        for token in tokens:
+            matches = prefixes.get(token[:MAX_PREFIX_LENGTH], {})
+            if scores is None:
+                scores = dict(matches)
+            else:
+                scores = {
+                    position: score + matches[position] for position, score in scores.items() if position in matches
+                }
+        if not scores:
+            query_trigrams = set().union(*(get_trigrams(token) for token in tokens))
+            matches = Counter(position for trigram in query_trigrams for position in trigrams.get(trigram, ()))
+            scores = {
+                position: matched_trigrams for position, matched_trigrams in matches.items()
+                if matched_trigrams >= TRIGRAM_MATCH_SHARE * len(query_trigrams)
+            }
+        return [products[position] for position in sorted(scores, key=lambda position: (-scores[position], position))]
+
+    def rebuild(self, products):
+        with self._lock:
+            if products is self.index[0]:
+                return
+            prefixes = {}
+            trigrams = {}
+            for position, product in enumerate(products):
+                for weight, text in ((NAME_WEIGHT, product['name']), (DESCRIPTION_WEIGHT, product['description'])):
+                    for token in tokenize(text):
+                        for length in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1):
+                            matches = prefixes.setdefault(token[:length], {})
+                            matches[position] = max(matches.get(position, 0), weight)
+                        for trigram in get_trigrams(token):
+                            trigrams.setdefault(trigram, set()).add(position)
+            self.index = (products, prefixes, trigrams)
@@ -0,0 +1,40 @@
+import json
+import sqlite3
+from threading import Lock
+
+
+class KeyValueStore:
+    def __init__(self, filename, table):
+        self.table = table
+        self._lock = Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._connection.commit()
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._connection.execute(f'SELECT value FROM {self.table} WHERE key = ?', (str(key),)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, key, value):
+        with self._lock:
+            self._connection.execute(
+                f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?)',
+                (str(key), json.dumps(value, ensure_ascii=False))
+            )
+            self._connection.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._connection.execute(f'DELETE FROM {self.table} WHERE key = ?', (str(key),))
+            self._connection.commit()
+
+    def delete_older_than(self, field, timestamp):
+        with self._lock:
+            deleted = self._connection.execute(
+                f'DELETE FROM {self.table} WHERE IFNULL(json_extract(value, ?), 0) < ?',
+                (f'$.{field}', timestamp)
+            ).rowcount
+            self._connection.commit()
+        return deleted